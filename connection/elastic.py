@@ -1,23 +1,43 @@
 # -*- coding:utf-8 -*-
+import collections
+import json
+import queue
+import threading
+import time
+import uuid
+from functools import partial
+
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
 import pandas as pd
 from parade.connection import Datasource, Connection
+from parade.utils.log import logger
+
+from .pool import cached_client, datasource_key, iter_bounded
+
+# the index settings generated by the cluster, which are rejected on index creation
+_INTERNAL_SETTINGS = ('uuid', 'creation_date', 'creation_date_string', 'version', 'provided_name', 'resize')
 
 
 class ElasticConnection(Connection):
+    # the max number of http connections kept to each node
+    pool_size = 10
+
     def initialize(self, context, conf):
         Connection.initialize(self, context, conf)
+        self.pool_size = conf['pool_size'] if conf.has('pool_size') else self.pool_size
         assert self.datasource.host is not None, 'host of connection is required'
         assert self.datasource.port is not None, 'port of connection is required'
         assert self.datasource.db is not None, 'db of connection is required'
         assert self.datasource.driver is not None and self.datasource.driver == 'elastic', 'driver mismatch'
 
-    def open(self):
+    def _build_uri(self, with_db=True):
         uri = self.datasource.uri
         if uri is None:
             authen = None
-            uripart = self.datasource.host + ':' + str(self.datasource.port) + '/' + self.datasource.db
+            uripart = self.datasource.host + ':' + str(self.datasource.port)
+            if with_db:
+                uripart += '/' + self.datasource.db
             if self.datasource.user is not None:
                 authen = self.datasource.user
             if authen is not None and self.datasource.password is not None:
@@ -28,34 +48,303 @@ class ElasticConnection(Connection):
             if self.datasource.protocol is not None:
                 protocol = self.datasource.protocol
             uri = protocol + '://' + uripart
+        return uri
 
-        return Elasticsearch(uri)
+    def _cached_client(self, uri):
+        # the dead connections are marked and resurrected by the transport of the shared client
+        return cached_client(datasource_key('elastic', self.datasource, uri, self.pool_size),
+                             lambda: Elasticsearch(uri, maxsize=self.pool_size),
+                             lambda es: es.transport.close())
+
+    def open(self):
+        return self._cached_client(self._build_uri())
+
+    def _open_cluster(self):
+        # the scroll api is only served at the cluster level, so the db is not used as url prefix
+        return self._cached_client(self._build_uri(with_db=False))
 
     def load(self, table, **kwargs):
-        raise NotImplementedError
+        """
+        load all the documents of the type
+        :param table: the document type
+        :return: see *load_query*
+        """
+        return self.load_query({"query": {"match_all": {}}}, table=table, **kwargs)
 
     def load_query(self, query, **kwargs):
-        raise NotImplementedError
+        """
+        load the documents matching the query with sliced scroll, the slices are fetched in parallel
+        and the hits are assembled into columns directly
+        :param query: the search body, as dict or json string
+        :param table: the document type to search, all types if not specified
+        :param fields: the fields of *_source* to load, all fields if not specified
+        :param slices: the number of slices scrolled in parallel
+        :param size: the number of hits in each scroll page
+        :param scroll: the keep-alive time of the scroll context
+        :param chunk_size: if specified, return a generator of dataframes with at most *chunk_size* rows
+        :return: the dataframe indexed by *_id*, or the generator of the dataframe chunks
+        """
+        if isinstance(query, str):
+            query = json.loads(query)
+        body = dict(query)
 
-    def store(self, df, table, **kwargs):
-        if isinstance(df, pd.DataFrame):
-            es = self.open()
+        fields = kwargs.get('fields', None)
+        if fields is not None:
+            body['_source'] = list(fields)
+        search_kwargs = {
+            'index': self.datasource.db,
+            'scroll': kwargs.get('scroll', '5m'),
+            'size': kwargs.get('size', 1000),
+        }
+        if kwargs.get('table', None) is not None:
+            search_kwargs['doc_type'] = kwargs['table']
+
+        slices = kwargs.get('slices', 4)
+        chunk_size = kwargs.get('chunk_size', None)
+
+        chunks = self._assemble(self._scan(body, search_kwargs, slices), fields, chunk_size)
+        if chunk_size is not None:
+            return chunks
+        frames = list(chunks)
+        if len(frames) == 0:
+            return pd.DataFrame(columns=fields)
+        return frames[0] if len(frames) == 1 else pd.concat(frames)
+
+    def _scan(self, body, search_kwargs, slices):
+        """
+        scroll the slices in parallel threads
+        :return: the generator of the hit pages, in the order they are fetched
+        """
+        es = self._open_cluster()
+        # bound the pages in memory if the consumer falls behind
+        pages = queue.Queue(maxsize=slices * 2)
+        stopped = threading.Event()
+
+        def _put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _scroll_slice(slice_id):
+            scroll_id = None
+            try:
+                slice_body = dict(body)
+                if slices > 1:
+                    slice_body['slice'] = {'id': slice_id, 'max': slices}
+                resp = es.search(body=slice_body, **search_kwargs)
+                scroll_id = resp.get('_scroll_id')
+                while len(resp['hits']['hits']) > 0 and _put(resp['hits']['hits']):
+                    resp = es.scroll(scroll_id=scroll_id, scroll=search_kwargs['scroll'])
+                    scroll_id = resp.get('_scroll_id')
+                _put(None)
+            except Exception as e:
+                _put(e)
+            finally:
+                if scroll_id is not None:
+                    try:
+                        es.clear_scroll(scroll_id=scroll_id)
+                    except Exception:
+                        pass
+
+        threads = [threading.Thread(target=_scroll_slice, args=(i,), daemon=True) for i in range(slices)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            running = slices
+            while running > 0:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            # stop the slices if the consumer exits early
+            stopped.set()
+
+    @staticmethod
+    def _assemble(pages, fields=None, chunk_size=None):
+        """
+        assemble the hits into column arrays, the fields missing in some hits are filled with None
+        :return: the generator of the dataframes
+        """
+        columns = collections.OrderedDict([(f, []) for f in fields]) if fields is not None else collections.OrderedDict()
+        ids = []
 
-            records = df.to_dict(orient='records')
+        def _flush():
+            df = pd.DataFrame(columns, index=pd.Index(ids, name='_id'))
+            columns.clear()
+            if fields is not None:
+                columns.update([(f, []) for f in fields])
+            del ids[:]
+            return df
 
-            if df.index.name:
-                actions = [{
-                    "_index": self.datasource.db,
+        for hits in pages:
+            for hit in hits:
+                source = hit.get('_source', {})
+                if fields is not None:
+                    for field in fields:
+                        columns[field].append(source.get(field))
+                else:
+                    for field, value in source.items():
+                        if field not in columns:
+                            columns[field] = [None] * len(ids)
+                        columns[field].append(value)
+                ids.append(hit['_id'])
+                if fields is None:
+                    for column in columns.values():
+                        if len(column) < len(ids):
+                            column.append(None)
+
+                if chunk_size is not None and len(ids) >= chunk_size:
+                    yield _flush()
+
+        if len(ids) > 0:
+            yield _flush()
+
+    @staticmethod
+    def _gen_actions(df, index, table):
+        """
+        generate the bulk actions of the dataframe chunk lazily
+        """
+        records = df.to_dict(orient='records')
+        if df.index.name:
+            for _id, record in zip(df.index.tolist(), records):
+                yield {
+                    "_index": index,
                     "_type": table,
-                    "_id": record[df.index.name],
+                    "_id": _id,
                     "_source": record
-                } for record in records]
-            else:
-                actions = [{
-                    "_index": self.datasource.db,
+                }
+        else:
+            for record in records:
+                yield {
+                    "_index": index,
                     "_type": table,
                     "_source": record
-                } for record in records]
+                }
+
+    def store(self, df, table, **kwargs):
+        """
+        index the dataframe in chunks, the chunks are bulk-indexed by several threads
+        with a bounded number of chunks in memory
+        :param chunk_size: the number of rows in each chunk
+        :param max_chunk_bytes: the max size of each bulk request
+        :param thread_count: the number of threads sending the bulk requests
+        :param if_exists: *append* to the index, or *replace* it with a new index swapped in by alias
+        :param bulk_load: disable refresh and replicas of the index during the writes
+        :param forcemerge: the max number of segments to force-merge into after a bulk-load
+        :param raise_on_error: raise if any document failed to append, otherwise only log the failures
+        :return: the (success, failed) counts of each chunk
+        """
+        if not isinstance(df, pd.DataFrame):
+            return []
+
+        if_exists = kwargs.get('if_exists', 'append')
+        assert if_exists in ('append', 'replace'), 'if_exists should be append or replace'
+        if if_exists == 'replace':
+            return self._replace_store(df, table, **kwargs)
+
+        index = self.datasource.db
+        if not kwargs.get('bulk_load', False):
+            stats = self._bulk_store(df, index, table, **kwargs)
+        else:
+            es = self._open_cluster()
+            settings = list(es.indices.get_settings(index=index).values())[0]['settings']['index']
+            es.indices.put_settings(index=index, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+            try:
+                stats = self._bulk_store(df, index, table, **kwargs)
+            finally:
+                self._restore_settings(es, index, settings, kwargs.get('forcemerge', None))
+
+        # the chunks are indexed without raising to keep the others going, the failures are reported at last
+        failed = sum([f for (_, f) in stats])
+        if failed > 0:
+            message = '{} of {} documents failed to index into {}'.format(failed, len(df), index)
+            if kwargs.get('raise_on_error', True):
+                raise RuntimeError(message)
+            logger.error(message)
+        return stats
+
+    def _replace_store(self, df, table, **kwargs):
+        """
+        bulk-load the dataframe into a fresh index, and swap the alias (named by db) to it atomically,
+        so that the readers never see a half-loaded index
+        """
+        es = self._open_cluster()
+        alias = self.datasource.db
+        # the random suffix keeps the replace-stores in the same second apart
+        index = '{}_{}_{}'.format(alias, time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+
+        # the new index inherits the mappings and the settings (analysis, shards, replicas...) of the current one
+        settings, mappings = {}, None
+        if es.indices.exists(index=alias):
+            current = list(es.indices.get(index=alias).values())[0]
+            settings = current['settings']['index']
+            mappings = current.get('mappings')
+        index_settings = {k: v for (k, v) in settings.items() if k not in _INTERNAL_SETTINGS}
+        index_settings.update({'refresh_interval': '-1', 'number_of_replicas': 0})
+        body = {'settings': {'index': index_settings}}
+        if mappings:
+            body['mappings'] = mappings
+        es.indices.create(index=index, body=body)
+
+        try:
+            stats = self._bulk_store(df, index, table, **kwargs)
+            failed = sum([f for (_, f) in stats])
+            if failed > 0:
+                raise RuntimeError('{} documents failed to index into {}, alias {} is kept'.format(
+                    failed, index, alias))
+            self._restore_settings(es, index, settings, kwargs.get('forcemerge', None))
+        except Exception:
+            es.indices.delete(index=index, ignore=[404])
+            raise
+
+        actions = []
+        obsolete = []
+        if es.indices.exists_alias(name=alias):
+            obsolete = list(es.indices.get_alias(name=alias).keys())
+            actions.extend([{'remove': {'index': name, 'alias': alias}} for name in obsolete])
+        elif es.indices.exists(index=alias):
+            # the concrete index is replaced by the alias of the same name
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index, 'alias': alias}})
+        es.indices.update_aliases(body={'actions': actions})
+
+        for name in obsolete:
+            es.indices.delete(index=name, ignore=[404])
+        return stats
+
+    @staticmethod
+    def _restore_settings(es, index, settings, forcemerge=None):
+        """
+        restore the refresh interval and the replicas after a bulk-load, the unset ones are reset to default
+        """
+        es.indices.put_settings(index=index, body={'index': {
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas'),
+        }})
+        es.indices.refresh(index=index)
+        if forcemerge is not None:
+            es.indices.forcemerge(index=index, max_num_segments=forcemerge)
+
+    def _bulk_store(self, df, index, table, **kwargs):
+        chunk_size = kwargs.get('chunk_size', 500)
+        max_chunk_bytes = kwargs.get('max_chunk_bytes', 100 * 1024 * 1024)
+        thread_count = kwargs.get('thread_count', 4)
+
+        es = self.open()
+
+        def _bulk(chunk):
+            return helpers.bulk(es, self._gen_actions(chunk, index, table), chunk_size=chunk_size,
+                                max_chunk_bytes=max_chunk_bytes, raise_on_error=False, stats_only=True)
 
-            if len(actions) > 0:
-                helpers.bulk(es, actions)
+        # at most 2 chunks per thread are kept in memory
+        jobs = (partial(_bulk, df.iloc[start:start + chunk_size]) for start in range(0, len(df), chunk_size))
+        return list(iter_bounded(jobs, thread_count))
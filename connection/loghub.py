@@ -1,24 +1,72 @@
 import base64
 import datetime
 import time
+import zlib
 import hashlib
 import hmac
 import json
-from functools import reduce
+import os
+from functools import partial, reduce
 import pandas as pd
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from parade.connection import Connection, Datasource
+from parade.utils.log import logger
+
+from .pool import cached_client, datasource_key, iter_bounded
 
 
 class Loghub(Connection):
     CONNECTION_TIME_OUT = 20
     API_VERSION = '0.6.0'
     USER_AGENT = 'log-python-sdk-v-0.6.1'
+    # the max number of lines returned by one GetLogs request
+    MAX_PAGE_SIZE = 100
+    # the max number of logs and the max raw size of one PutLogs request
+    MAX_BATCH_ROWS = 4096
+    MAX_BATCH_BYTES = 3 * 1024 * 1024
+
+    # the max number of keep-alive connections to the endpoint
+    pool_size = 10
+    # the number of the requests sent at the same time
+    concurrency = 8
+    # the max attempts of a request, waiting exponentially longer between the attempts
+    retries = 3
+    backoff = 0.5
+    # the cached time windows are aligned to *cache_window* seconds, and only the ones ended
+    # *cache_lag* seconds ago are cached, the oldest cache files are evicted beyond *cache_size* bytes
+    cache_window = 3600
+    cache_lag = 600
+    cache_size = 1024 * 1024 * 1024
 
     def initialize(self, context, conf):
         Connection.initialize(self, context, conf)
+        self.context = context
+        self.pool_size = conf['pool_size'] if conf.has('pool_size') else self.pool_size
+        self.concurrency = conf['concurrency'] if conf.has('concurrency') else self.concurrency
+        self.retries = conf['retries'] if conf.has('retries') else self.retries
+        self.backoff = conf['backoff'] if conf.has('backoff') else self.backoff
+        self.cache_window = conf['cache_window'] if conf.has('cache_window') else self.cache_window
+        self.cache_lag = conf['cache_lag'] if conf.has('cache_lag') else self.cache_lag
+        self.cache_size = conf['cache_size'] if conf.has('cache_size') else self.cache_size
+
+    def _session(self):
+        """
+        the keep-alive session shared by all the requests to the same endpoint in the process
+        """
+
+        def _create_session():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            return session
+
+        return cached_client(datasource_key('loghub', self.datasource, self.pool_size), _create_session,
+                             lambda session: session.close())
 
     def _getGMT(self):
         return datetime.datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
@@ -34,15 +82,9 @@ class Loghub(Connection):
 
     def _getHttpResponse(self, method, url, params, body, headers):  # ensure method, url, body is str
         headers['User-Agent'] = Loghub.USER_AGENT
-        r = None
-        if method.lower() == 'get':
-            r = requests.get(url, params=params, data=body, headers=headers, timeout=Loghub.CONNECTION_TIME_OUT)
-        elif method.lower() == 'post':
-            r = requests.post(url, params=params, data=body, headers=headers, timeout=Loghub.CONNECTION_TIME_OUT)
-        elif method.lower() == 'put':
-            r = requests.put(url, params=params, data=body, headers=headers, timeout=Loghub.CONNECTION_TIME_OUT)
-        elif method.lower() == 'delete':
-            r = requests.delete(url, params=params, data=body, headers=headers, timeout=Loghub.CONNECTION_TIME_OUT)
+        assert method.lower() in ('get', 'post', 'put', 'delete'), 'unsupported method ' + method
+        r = self._session().request(method.upper(), url, params=params, data=body, headers=headers,
+                                    timeout=Loghub.CONNECTION_TIME_OUT)
         return r.status_code, r.content.decode(), r.headers
 
     def _sendRequest(self, method, url, params, body, headers, respons_body_type='json'):
@@ -94,7 +136,7 @@ class Loghub(Connection):
     def hmac_sha1(content, key):
         content = content.encode()
         hashed = hmac.new(key.encode(), content, hashlib.sha1).digest()
-        return base64.encodestring(hashed).rstrip()
+        return base64.encodebytes(hashed).rstrip()
 
     @staticmethod
     def get_request_authorization(method, resource, key, params, headers):
@@ -174,7 +216,267 @@ class Loghub(Connection):
         (resp, header) = self._send("GET", None, resource, params, headers)
         return resp, header
 
+    def _retry(self, request, description, check_progress=True):
+        """
+        send the request, retry with exponential backoff if it fails or the result is incomplete
+        :param request: the function sending the request and returning the response and its headers
+        :param check_progress: retry if the progress in the response headers is not complete
+        :return: the last response, and whether it is complete
+        """
+        resp = None
+        for retry_time in range(0, self.retries):
+            try:
+                resp, header = request()
+                if resp is not None and (not check_progress or header['x-log-progress'] == 'Complete'):
+                    return resp, True
+            except Exception as e:
+                if retry_time == self.retries - 1:
+                    raise
+                logger.warning('failed to {}: {}'.format(description, e))
+            if retry_time < self.retries - 1:
+                time.sleep(self.backoff * 2 ** retry_time)
+        return (resp if resp is not None else []), False
+
+    def _get_logs_page(self, logstore, query, topic, from_time, to_time, offset, lines):
+        return self._retry(
+            lambda: self.get_logs(logstore, query, topic, from_time, to_time, offset, lines, False),
+            'get logs of {} in [{}, {}) at offset {}'.format(logstore, from_time, to_time, offset))
+
+    def _get_histogram(self, logstore, query, topic, from_time, to_time):
+        return self._retry(
+            lambda: self.get_histograms(logstore, query, topic, from_time=from_time, to_time=to_time),
+            'get histograms of {} in [{}, {})'.format(logstore, from_time, to_time))
+
+    def _split_window(self, logstore, query, topic, histogram, max_rows):
+        """
+        merge the adjacent histogram buckets into the time slices with at most *max_rows* lines,
+        the denser buckets are subdivided recursively with the histograms of their own windows
+        :return: the list of the [from, to, count] slices in time order, and whether all the sub-histograms are complete
+        """
+        slices = []
+        complete = True
+        current = None
+        for bucket in sorted(histogram, key=lambda b: int(b['from'])):
+            bucket_from, bucket_to, count = int(bucket['from']), int(bucket['to']), bucket['count']
+            if count == 0:
+                continue
+            if count > max_rows and bucket_to - bucket_from > 1:
+                sub_histogram, sub_complete = self._get_histogram(logstore, query, topic, bucket_from, bucket_to)
+                if len(sub_histogram) <= 1:
+                    # the window is too short to have finer buckets, split it in halves
+                    middle = (bucket_from + bucket_to) // 2
+                    left, left_complete = self._get_histogram(logstore, query, topic, bucket_from, middle)
+                    right, right_complete = self._get_histogram(logstore, query, topic, middle, bucket_to)
+                    sub_histogram, sub_complete = left + right, left_complete and right_complete
+                sub_slices, slices_complete = self._split_window(logstore, query, topic, sub_histogram, max_rows)
+                slices.extend(sub_slices)
+                complete = complete and sub_complete and slices_complete
+                current = None
+            elif current is not None and current[2] + count <= max_rows:
+                current[1] = bucket_to
+                current[2] += count
+            else:
+                current = [bucket_from, bucket_to, count]
+                slices.append(current)
+        return slices, complete
+
+    @staticmethod
+    def _parse_numbers(values):
+        """
+        convert the strings to numbers only if all of them round-trip, the ones with leading zeros
+        (e.g. ids) and the integers beyond the precision of float are kept as strings
+        :return: the numeric series, or None if any value is not convertible
+        """
+        strings = values.dropna().astype(str)
+        numbers = pd.to_numeric(strings, errors='coerce')
+        if numbers.isna().any() or strings.str.match(r'^[+-]?0\d').any():
+            return None
+        integers = strings.str.fullmatch(r'[+-]?\d+')
+        if (numbers[integers].abs() > 2 ** 53).any():
+            return None
+        return pd.to_numeric(values)
+
+    @staticmethod
+    def _infer_schema(df, category_ratio=0.5):
+        """
+        infer the dtypes of the string fields, *__time__* is parsed as datetime, the fields with only numbers
+        are numeric, and the fields with less distinct values than *category_ratio* of the rows are categorical
+        :param category_ratio: the max ratio of the distinct values of a categorical field, None to infer no category
+        :return: the dict of the field and its dtype
+        """
+        schema = {}
+        for column in df.columns:
+            if column == '__time__':
+                schema[column] = 'datetime'
+                continue
+            values = df[column].dropna()
+            if len(values) == 0:
+                continue
+            if Loghub._parse_numbers(values) is not None:
+                schema[column] = 'numeric'
+            elif category_ratio is not None and values.nunique() <= len(values) * category_ratio:
+                schema[column] = 'category'
+        return schema
+
+    @staticmethod
+    def _coerce(df, schema, inferred=False):
+        """
+        convert the fields of the dataframe by the schema
+        :param schema: the dict of the field and its dtype, which is *numeric*, *datetime* (from unix timestamp
+        or datetime string) or any dtype supported by pandas
+        :param inferred: whether the schema is inferred, the fields not convertible by the inferred schema
+        are kept as strings, while the values not convertible by the given schema become null
+        """
+        for column, dtype in schema.items():
+            if column not in df.columns:
+                continue
+            if dtype == 'numeric':
+                numbers = Loghub._parse_numbers(df[column]) if inferred else pd.to_numeric(df[column],
+                                                                                           errors='coerce')
+                if numbers is not None:
+                    df[column] = numbers
+                else:
+                    logger.warning('field {} is kept as strings, some values are not numeric'.format(column))
+            elif dtype == 'datetime':
+                numbers = pd.to_numeric(df[column], errors='coerce')
+                if numbers.notna().sum() == df[column].notna().sum():
+                    df[column] = pd.to_datetime(numbers, unit='s')
+                elif not inferred:
+                    df[column] = pd.to_datetime(df[column], errors='coerce')
+                else:
+                    try:
+                        df[column] = pd.to_datetime(df[column])
+                    except (ValueError, TypeError):
+                        logger.warning('field {} is kept as strings, some values are not datetime'.format(column))
+            else:
+                df[column] = df[column].astype(dtype)
+        return df
+
+    def _iter_chunks(self, pages, chunk_size, schema=None):
+        """
+        regroup the log lines of the pages into the dataframes of *chunk_size* lines
+        :param schema: the schema to convert the chunks, inferred from the first chunk if not specified,
+        without categorical fields since the categories of the chunks would differ
+        """
+        log_lines = []
+        inferred = schema is None
+
+        def _build(lines):
+            nonlocal schema
+            df = pd.DataFrame(lines)
+            if schema is None:
+                # the later chunks keep the same dtypes as the first one if convertible
+                schema = self._infer_schema(df, category_ratio=None)
+            return self._coerce(df, schema, inferred)
+
+        for page in pages:
+            log_lines.extend(page)
+            while len(log_lines) >= chunk_size:
+                yield _build(log_lines[:chunk_size])
+                log_lines = log_lines[chunk_size:]
+        if len(log_lines) > 0:
+            yield _build(log_lines)
+
+    def _cache_dir(self):
+        return os.path.join(self.context.workdir, 'loghub', 'cache')
+
+    def _cache_file(self, logstore, query, topic, from_time, to_time):
+        key = json.dumps([self.datasource.db, logstore, topic, query, from_time, to_time])
+        return os.path.join(self._cache_dir(), hashlib.sha1(key.encode()).hexdigest() + '.parquet')
+
+    def _split_cache_windows(self, from_time, to_time):
+        """
+        split the time window at the boundaries of the cache windows
+        :return: the list of the (from, to, cacheable) windows
+        """
+        closed_time = int(time.time()) - self.cache_lag
+        windows = []
+        window_from = from_time
+        while window_from < to_time:
+            window_to = min((window_from // self.cache_window + 1) * self.cache_window, to_time)
+            # only the complete and closed windows are cacheable
+            cacheable = window_from % self.cache_window == 0 and window_to % self.cache_window == 0 \
+                        and window_to <= closed_time
+            windows.append((window_from, window_to, cacheable))
+            window_from = window_to
+        return windows
+
+    @staticmethod
+    def _read_cache(cache_file):
+        """
+        :return: the cached log lines, and whether they are complete (always)
+        """
+        os.utime(cache_file)
+        return pd.read_parquet(cache_file).to_dict(orient='records'), True
+
+    def _write_cache(self, cache_file, log_lines):
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = cache_file + '.tmp'
+            pd.DataFrame(log_lines).to_parquet(tmp_file)
+            os.replace(tmp_file, cache_file)
+        except (ImportError, OSError) as e:
+            logger.warning('failed to cache logs into {}: {}'.format(cache_file, e))
+            return
+        self._evict_cache()
+
+    def _evict_cache(self):
+        """
+        remove the least recently used cache files until the cache fits in *cache_size*
+        """
+        cache_dir = self._cache_dir()
+        files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.parquet')]
+        stats = sorted([(os.path.getmtime(f), os.path.getsize(f), f) for f in files])
+        total_size = sum([size for (_, size, _) in stats])
+        for (_, size, cache_file) in stats:
+            if total_size <= self.cache_size:
+                break
+            try:
+                os.remove(cache_file)
+            except OSError:
+                continue
+            total_size -= size
+
+    def _plan_pages(self, logstore, query, topic, from_time, to_time, limit, page_size, slice_rows):
+        """
+        plan the pages of the time window by the histogram slices
+        :return: the list of the (from, to, offset, lines) of the pages, and whether the window is planned completely,
+        i.e. all the histograms are complete and no page is cut by the limit
+        """
+        histogram, histogram_complete = self._get_histogram(logstore, query, topic, from_time, to_time)
+        slices, slices_complete = self._split_window(logstore, query, topic, histogram, slice_rows)
+
+        total_count = reduce(lambda x, y: x + y, map(lambda x: x[2], slices), 0)
+        complete = histogram_complete and slices_complete and (limit < 0 or limit >= total_count)
+        limit = total_count if limit < 0 else min(limit, total_count)
+
+        pages = []
+        for (slice_from, slice_to, count) in slices:
+            count = min(count, limit)
+            pages.extend([(slice_from, slice_to, offset, min(page_size, count - offset))
+                          for offset in range(0, count, page_size)])
+            limit -= count
+            if limit <= 0:
+                break
+        return pages, complete
+
     def load_query(self, query, **kwargs):
+        """
+        load the logs matching the query, the window is split into time slices by the histogram
+        to keep the offsets shallow, and the pages of the slices are fetched concurrently and reassembled in order
+        :param query: the dict or the url-encoded string with *logstore*, *topic*, *query*, *from*, *to*
+        and *limit*, the max number of lines (*chunk_size* in query is deprecated as the limit)
+        :param limit: the max number of lines, overrides the one in query, the only limit of the lines
+        :param chunk_size: if specified, return a generator of dataframes with at most *chunk_size* lines,
+        which does not limit the lines loaded
+        :param page_size: the number of lines in each request, up to *MAX_PAGE_SIZE*
+        :param slice_rows: the max number of lines in each time slice
+        :param concurrency: the number of the pages fetched at the same time
+        :param cache: cache the logs of the closed time windows under the workdir, and load them from the cache later
+        :param schema: the dict of the field and its dtype (see *_coerce*), inferred if not specified,
+        pass an empty dict to keep the strings
+        :return: the dataframe of the log lines, or the generator of the dataframe chunks
+        """
         if isinstance(query, str):
             query = dict(map(lambda x: x.split('='), query.split('&')))
 
@@ -189,27 +491,173 @@ class Loghub(Connection):
         logstore = query.get('logstore')
         topic = query.get('topic')
         _query = query.get('query')
-        to_time = query.get('to', int(time.time()))
-        from_time = query.get('from', to_time - 600)
-        limit = query.get('chunk_size', -1)
-
-        (histogram, header) = self.get_histograms(logstore, _query, topic, from_time=from_time, to_time=to_time)
+        to_time = int(query.get('to', int(time.time())))
+        from_time = int(query.get('from', to_time - 600))
+        if 'chunk_size' in query:
+            logger.warning('<chunk_size> in query is deprecated as the max number of lines, use <limit> instead')
+        limit = int(kwargs.get('limit', query.get('limit', query.get('chunk_size', -1))))
+        chunk_size = kwargs.get('chunk_size', None)
+        page_size = min(kwargs.get('page_size', Loghub.MAX_PAGE_SIZE), Loghub.MAX_PAGE_SIZE)
+        slice_rows = kwargs.get('slice_rows', 10000)
+        concurrency = kwargs.get('concurrency', self.concurrency)
+        cache = kwargs.get('cache', False)
+        schema = kwargs.get('schema', None)
+
+        windows = self._split_cache_windows(from_time, to_time) if cache else [(from_time, to_time, False)]
+
+        # each job loads a page and tells whether it is complete, the logs fetched in a cacheable window
+        # are written to the cache file after its last page if all its pages are complete,
+        # as (cache file, last page of window, job)
+        jobs = []
+        for (window_from, window_to, cacheable) in windows:
+            cache_file = self._cache_file(logstore, _query, topic, window_from, window_to) if cacheable else None
+            if cache_file is not None and os.path.exists(cache_file):
+                jobs.append((None, False, partial(self._read_cache, cache_file)))
+                continue
+            pages, complete = self._plan_pages(logstore, _query, topic, window_from, window_to, limit,
+                                               page_size, slice_rows)
+            if not complete:
+                cache_file = None
+            if cache_file is not None and len(pages) == 0:
+                self._write_cache(cache_file, [])
+            jobs.extend([(cache_file, i == len(pages) - 1, partial(self._get_logs_page, logstore, _query, topic, *page))
+                         for (i, page) in enumerate(pages)])
+
+        def _load_pages():
+            remaining = limit
+            window_lines = []
+            window_complete = True
+            results = iter_bounded([j for (_, _, j) in jobs], concurrency)
+            for ((cache_file, last_page, _), (page, complete)) in zip(jobs, results):
+                if cache_file is not None:
+                    window_lines.extend(page)
+                    window_complete = window_complete and complete
+                    if last_page:
+                        if window_complete:
+                            self._write_cache(cache_file, window_lines)
+                        else:
+                            logger.warning('skip caching the incomplete logs into {}'.format(cache_file))
+                        window_lines = []
+                        window_complete = True
+                if remaining >= 0:
+                    page = page[:remaining]
+                    remaining -= len(page)
+                yield page
+                if remaining == 0:
+                    break
 
-        total_count = reduce(lambda x, y: x + y, map(lambda x: x['count'], histogram), 0)
-        limit = total_count if limit < 0 else min(limit, total_count)
+        log_pages = _load_pages()
+        if chunk_size is not None:
+            return self._iter_chunks(log_pages, chunk_size, schema)
 
         log_lines = []
-        log_line = 64
-        
-        for offset in range(0, limit, log_line):
-            resp = None
-            for retry_time in range(0, 3):
-                resp, header = self.get_logs(logstore, _query, topic, from_time, to_time, offset, log_line, False)
-                if resp is not None and header['x-log-progress'] == 'Complete':
-                    break
-                time.sleep(1)
-            if resp is not None:
-                log_lines.extend(resp)
+        for page in log_pages:
+            log_lines.extend(page)
+        df = pd.DataFrame(log_lines)
+        del log_lines
+        if schema is None:
+            return self._coerce(df, self._infer_schema(df), inferred=True)
+        return self._coerce(df, schema)
 
-        return pd.DataFrame(log_lines)
+    @staticmethod
+    def _encode_varint(value):
+        encoded = bytearray()
+        while value > 0x7f:
+            encoded.append((value & 0x7f) | 0x80)
+            value >>= 7
+        encoded.append(value)
+        return bytes(encoded)
+
+    @staticmethod
+    def _encode_field(number, payload):
+        """
+        encode the length-delimited protobuf field
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        return Loghub._encode_varint(number << 3 | 2) + Loghub._encode_varint(len(payload)) + payload
 
+    @staticmethod
+    def _encode_log(log_time, record):
+        """
+        encode the record as the protobuf *Log* message with its *Content* fields
+        """
+        encoded = Loghub._encode_varint(1 << 3) + Loghub._encode_varint(log_time)
+        for key, value in record.items():
+            if value is None or value != value:
+                # skip the null and NaN fields
+                continue
+            content = Loghub._encode_field(1, str(key)) + Loghub._encode_field(2, str(value))
+            encoded += Loghub._encode_field(2, content)
+        return encoded
+
+    def _gen_batches(self, df, batch_rows, batch_bytes):
+        """
+        encode the rows and group them into the batches within the count and the size limits
+        :return: the generator of the encoded logs of each batch
+        """
+        if '__time__' in df.columns:
+            times = df['__time__']
+            if pd.api.types.is_datetime64_any_dtype(times):
+                if times.dt.tz is not None:
+                    times = times.dt.tz_convert('UTC').dt.tz_localize(None)
+                times = times.values.astype('datetime64[s]')
+            times = times.astype('int64').tolist()
+            records = df.drop(columns=['__time__']).to_dict(orient='records')
+        else:
+            times = [int(time.time())] * len(df)
+            records = df.to_dict(orient='records')
+
+        batch, batch_size = [], 0
+        for (log_time, record) in zip(times, records):
+            log = Loghub._encode_field(1, Loghub._encode_log(log_time, record))
+            if len(batch) > 0 and (len(batch) >= batch_rows or batch_size + len(log) > batch_bytes):
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(log)
+            batch_size += len(log)
+        if len(batch) > 0:
+            yield batch
+
+    def put_logs(self, logstore, logs, topic=None, source=None):
+        """
+        put the encoded logs to log service in one request, the payload is compressed with deflate
+        :param logs: the encoded protobuf *Log* fields
+        :return: the number of logs
+        """
+        body = b''.join(logs)
+        if topic:
+            body += Loghub._encode_field(3, topic)
+        if source:
+            body += Loghub._encode_field(4, source)
+        headers = {
+            'Content-Type': 'application/x-protobuf',
+            'x-log-bodyrawsize': str(len(body)),
+            'x-log-compresstype': 'deflate',
+        }
+        resource = "/logstores/" + logstore + "/shards/lb"
+        self._retry(lambda: self._send("POST", zlib.compress(body), resource, {}, dict(headers), 'raw'),
+                    'put logs to {}'.format(logstore), check_progress=False)
+        return len(logs)
+
+    def store(self, df, table, **kwargs):
+        """
+        put the rows of the dataframe to the logstore, the rows are packed into batched requests sent concurrently
+        :param table: the logstore
+        :param topic: the topic of the logs
+        :param source: the source of the logs
+        :param batch_rows: the max number of logs in each request
+        :param batch_bytes: the max size of the uncompressed logs in each request
+        :param concurrency: the number of the requests sent at the same time
+        :return: the number of logs put
+        """
+        assert isinstance(df, pd.DataFrame), 'not supported data type'
+        topic = kwargs.get('topic', None)
+        source = kwargs.get('source', None)
+        batch_rows = min(kwargs.get('batch_rows', Loghub.MAX_BATCH_ROWS), Loghub.MAX_BATCH_ROWS)
+        batch_bytes = min(kwargs.get('batch_bytes', Loghub.MAX_BATCH_BYTES), Loghub.MAX_BATCH_BYTES)
+        concurrency = kwargs.get('concurrency', self.concurrency)
+
+        jobs = (partial(self.put_logs, table, batch, topic, source)
+                for batch in self._gen_batches(df, batch_rows, batch_bytes))
+        return sum(iter_bounded(jobs, concurrency))
@@ -0,0 +1,134 @@
+import atexit
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from parade.utils.log import logger
+
+_lock = threading.Lock()
+_clients = {}
+_closers = {}
+
+
+def datasource_key(driver, datasource, *options):
+    """
+    build the registry key of the client from the datasource settings
+    :param driver: the type of the client
+    :param options: the other settings affecting the client, e.g. the pool size
+    :return:
+    """
+    return (driver, datasource.uri, datasource.protocol, datasource.host, datasource.port, datasource.db,
+            datasource.user, datasource.password) + options
+
+
+def cached_client(key, factory, closer=None):
+    """
+    get the client shared in the process, the client is created by the factory at the first call,
+    and reused by the later calls from any thread
+    :param key: the registry key of the client
+    :param factory: the function to create the client
+    :param closer: the function to release the client at shutdown
+    :return:
+    """
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        if key not in _clients:
+            _clients[key] = factory()
+            if closer is not None:
+                _closers[key] = closer
+        return _clients[key]
+
+
+def close_clients():
+    """
+    release the connection pools of all the cached clients
+    :return:
+    """
+    with _lock:
+        for key, client in _clients.items():
+            closer = _closers.get(key)
+            if closer is None:
+                continue
+            try:
+                closer(client)
+            except Exception as e:
+                logger.warning('failed to close client of {}: {}'.format(key[0], e))
+        _clients.clear()
+        _closers.clear()
+
+
+atexit.register(close_clients)
+
+
+def redis_pool(datasource, pool_size=50, health_check_interval=0):
+    """
+    get the redis connection pool shared by all the connections of the same datasource in the process
+    :param pool_size: the max number of connections in the pool
+    :param health_check_interval: ping the connections idle longer than the interval (in seconds) before using them,
+    0 to disable
+    :return:
+    """
+    import redis
+
+    def _create_pool():
+        pool_kwargs = {'max_connections': pool_size}
+        if health_check_interval:
+            pool_kwargs['health_check_interval'] = health_check_interval
+        if datasource.password:
+            pool_kwargs['password'] = datasource.password
+        return redis.ConnectionPool(host=datasource.host if datasource.host else 'localhost',
+                                    port=datasource.port if datasource.port else 6379,
+                                    db=datasource.db if datasource.db else 0, **pool_kwargs)
+
+    return cached_client(datasource_key('redis', datasource, pool_size, health_check_interval),
+                         _create_pool, lambda p: p.disconnect())
+
+
+class FlushingPipeline(object):
+    """
+    the redis pipeline executed every *size* commands, to bound the memory of the client and the server
+    """
+
+    def __init__(self, conn, size=1000, transaction=False):
+        self.pipe = conn.pipeline(transaction=transaction)
+        self.size = size
+        self.pending = 0
+        self.results = []
+
+    def execute_command(self, *args):
+        self.pipe.execute_command(*args)
+        self.pending += 1
+        if self.pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.pending > 0:
+            self.results.extend(self.pipe.execute())
+            self.pending = 0
+        return self.results
+
+
+def iter_bounded(jobs, concurrency, backlog=2):
+    """
+    run the jobs in a thread pool with a bounded number of results in memory, the jobs not started yet
+    are cancelled if the consumer stops early or a job fails
+    :param jobs: the functions to run, e.g. fetching a page or sending a batch
+    :param concurrency: the number of the jobs run at the same time
+    :param backlog: the max number of the jobs submitted per thread
+    :return: the generator of the results in the order of the jobs
+    """
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = collections.deque()
+        try:
+            for job in jobs:
+                # wait for the earliest job to keep at most *backlog* results per thread in memory
+                if len(pending) >= concurrency * backlog:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(job))
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
@@ -3,8 +3,20 @@ import redis
 from parade.connection import Connection
 import pandas as pd
 
+from .pool import FlushingPipeline, redis_pool
+
 
 class RedisCounterConnection(Connection):
+    # the max number of connections in the pool
+    pool_size = 50
+    health_check_interval = 0
+
+    def initialize(self, context, conf):
+        Connection.initialize(self, context, conf)
+        self.pool_size = conf['pool_size'] if conf.has('pool_size') else self.pool_size
+        self.health_check_interval = conf['health_check_interval'] if conf.has(
+            'health_check_interval') else self.health_check_interval
+
     def _gen_key(self, table, suffix=None, key=None):
         if not suffix:
             return table
@@ -17,41 +29,256 @@ class RedisCounterConnection(Connection):
             cache_key += ":" + suffix2
         return cache_key
 
+    LAYOUT_KEY = 'key'
+    LAYOUT_HASH = 'hash'
+
+    @staticmethod
+    def _split_table(table):
+        if isinstance(table, tuple) and len(table) > 1:
+            return table[0], '-'.join(table[1:])
+        return table[0] if isinstance(table, tuple) else table, None
+
+    def _gen_keys(self, table, suffix, row_keys):
+        """
+        the vectorised version of *_gen_key* for the keys of a column,
+        or the keys of the rows in hash layout if *suffix* is None
+        :param row_keys: the series of the row keys
+        :return: the series of the cache keys
+        """
+        table, suffix2 = self._split_table(table)
+        tail = ':counter' + (':' + str(suffix) if suffix is not None else '') + (':' + suffix2 if suffix2 else '')
+        keys = table + '-' + row_keys + tail
+        return keys.where(row_keys != '', table + tail)
+
+    @staticmethod
+    def _gen_row_keys(df, pkey):
+        row_keys = df[pkey[0]].astype(str)
+        for x in pkey[1:]:
+            row_keys = row_keys + '-' + df[x].astype(str)
+        return row_keys
+
+    def _parse_row_keys(self, table, keys, pkey):
+        """
+        parse the row keys of the rows in hash layout back into the pkey columns
+        :return: the dataframe of the pkey columns
+        """
+        table, suffix2 = self._split_table(table)
+        head = table + '-'
+        tail = ':counter' + (':' + suffix2 if suffix2 else '')
+        row_keys = pd.Series([k[len(head):len(k) - len(tail)] for k in keys], dtype=object)
+        return self._split_row_keys(row_keys, pkey)
+
+    @staticmethod
+    def _split_row_keys(row_keys, pkey):
+        """
+        split the row keys back into the pkey columns, the last column gets the rest of the row key
+        if the values contain '-', and a single pkey column gets the whole row key
+        :param row_keys: the series of the row keys
+        :return: the dataframe of the pkey columns, with the index of the row keys
+        """
+        if len(pkey) == 1:
+            return row_keys.to_frame(pkey[0])
+        parts = row_keys.str.split('-', n=len(pkey) - 1, expand=True)
+        return parts.reindex(columns=range(len(pkey))).set_axis(list(pkey), axis=1)
+
+    @staticmethod
+    def _escape_pattern(pattern):
+        for c in '\\*?[]':
+            pattern = pattern.replace(c, '\\' + c)
+        return pattern
+
+    @staticmethod
+    def _decode(value):
+        return value.decode() if isinstance(value, bytes) else value
+
+    @staticmethod
+    def _to_numeric(df, columns):
+        for column in columns:
+            try:
+                df[column] = pd.to_numeric(df[column])
+            except (ValueError, TypeError):
+                pass
+        return df
+
     def store(self, df, table, **kwargs):
+        """
+        store the counters, the keys of a dataframe are generated by columns and set with MSET in batches
+        :param pkey: the columns of the row key, required to store a dataframe
+        :param layout: store each cell in its own key (*key*), or each row as a hash (*hash*)
+        :param batch_size: the number of keys set in each MSET
+        :param pipeline_size: the number of commands sent in each pipeline
+        :return:
+        """
         pkey = kwargs.get('pkey', None)
         pkey = pkey if isinstance(pkey, tuple) else (pkey,)
+        batch_size = kwargs.get('batch_size', 1000)
+        layout = kwargs.get('layout', self.LAYOUT_KEY)
+
+        pipe = FlushingPipeline(self.open(), kwargs.get('pipeline_size', 100))
 
-        pipe = self.open().pipeline()
+        def _mset(keys, values):
+            for start in range(0, len(keys), batch_size):
+                args = []
+                for key, val in zip(keys[start:start + batch_size], values[start:start + batch_size]):
+                    args.append(key)
+                    args.append(val)
+                pipe.execute_command('MSET', *args)
 
         if isinstance(df, pd.DataFrame):
             assert pkey, 'pkey must be set to store dataframe'
-            for row_idx, row in df.iterrows():
-                row_key = '-'.join([str(row[x]) for x in pkey])
-                row_dict = row.drop(list(pkey)).to_dict()
+            row_keys = self._gen_row_keys(df, pkey)
+            columns = df.columns.drop(list(pkey))
 
-                for key, val in row_dict.items():
-                    cache_key = self._gen_key(table, key, row_key)
-                    pipe.set(cache_key, val)
+            if layout == self.LAYOUT_HASH:
+                fields = [str(c) for c in columns]
+                cache_keys = self._gen_keys(table, None, row_keys).tolist()
+                for cache_key, values in zip(cache_keys, zip(*[df[c].tolist() for c in columns])):
+                    args = [cache_key]
+                    for field, val in zip(fields, values):
+                        args.append(field)
+                        args.append(val)
+                    pipe.execute_command('HSET', *args)
+            else:
+                for key in columns:
+                    _mset(self._gen_keys(table, key, row_keys).tolist(), df[key].tolist())
 
         elif isinstance(df, dict):
-            for key, val in df.items():
-                pipe.set(self._gen_key(table, key), val)
+            _mset([self._gen_key(table, key) for key in df.keys()], list(df.values()))
 
         elif type(df) in (int, float, str):
-            pipe.set(table, df)
+            pipe.execute_command('SET', table, df)
 
         else:
             raise TypeError('not supported data type')
 
-        pipe.execute()
+        pipe.flush()
 
-    def open(self):
-        host = self.datasource.host if self.datasource.host else 'localhost'
-        port = self.datasource.port if self.datasource.port else 6379
-        db = self.datasource.db if self.datasource.db else 0
+    def _scan_unique(self, conn, pattern, count):
+        """
+        find the keys with SCAN, the keys returned more than once (e.g. during a rehash) are skipped
+        :return: the generator of the decoded keys
+        """
+        seen = set()
+        for key in conn.scan_iter(match=pattern, count=count):
+            key = self._decode(key)
+            if key not in seen:
+                seen.add(key)
+                yield key
 
-        conn = redis.StrictRedis(host=host, port=port, db=db,
-                                 password=self.datasource.password) if self.datasource.password else redis.StrictRedis(
-                host=host, port=port, db=db)
+    def _scan_mget(self, conn, pattern, batch_size, pipeline_size):
+        """
+        find the keys with SCAN and get the values with pipelined MGET in batches
+        :return: the keys and the values
+        """
+        keys, values = [], []
+        pipe = FlushingPipeline(conn, pipeline_size)
+        batch = []
+        for key in self._scan_unique(conn, pattern, batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                pipe.execute_command('MGET', *batch)
+                keys.extend(batch)
+                batch = []
+        if len(batch) > 0:
+            pipe.execute_command('MGET', *batch)
+            keys.extend(batch)
+        for batch_values in pipe.flush():
+            values.extend([self._decode(v) for v in batch_values])
+        return keys, values
 
-        return conn
+    def _parse_keys(self, table, keys, values, pkey):
+        """
+        parse the keys in key layout back into the row keys and the columns, and pivot the values into the wide dataframe
+        :return: the dataframe with the pkey columns and the other columns
+        """
+        table, suffix2 = self._split_table(table)
+        head = table + '-'
+        tail = ':' + suffix2 if suffix2 else ''
+        row_keys, columns = [], []
+        for key in keys:
+            row_key, column = key[len(head):len(key) - len(tail)].rsplit(':counter:', 1)
+            row_keys.append(row_key)
+            columns.append(column)
+
+        df = pd.DataFrame({'row_key': row_keys, 'column': columns, 'value': values}) \
+            .pivot(index='row_key', columns='column', values='value')
+        df.columns.name = None
+        df = self._to_numeric(df, df.columns)
+        row_df = self._split_row_keys(df.index.to_series(), pkey)
+        return pd.concat([row_df, df], axis=1).reset_index(drop=True)
+
+    def load(self, table, **kwargs):
+        """
+        load the rows of the table, the keys are found with SCAN and read with pipelined MGET (or HGETALL in
+        hash layout), and the row keys are parsed back into the pkey columns
+        :param pkey: the columns of the row key
+        :param layout: the layout the rows are stored in, *key* or *hash*
+        :param batch_size: the number of keys in each MGET
+        :param pipeline_size: the number of commands sent in each pipeline
+        :return: the dataframe with the pkey columns and the other columns
+        """
+        pkey = kwargs.get('pkey', None)
+        pkey = pkey if isinstance(pkey, tuple) else (pkey,)
+        assert pkey[0], 'pkey must be set to load dataframe'
+        layout = kwargs.get('layout', self.LAYOUT_KEY)
+        pipeline_size = kwargs.get('pipeline_size', 100)
+
+        conn = self.open()
+        table_name, suffix2 = self._split_table(table)
+        pattern_tail = ':' + self._escape_pattern(suffix2) if suffix2 else ''
+
+        if layout == self.LAYOUT_KEY:
+            pattern = self._escape_pattern(table_name) + '-*:counter:*' + pattern_tail
+            keys, values = self._scan_mget(conn, pattern, kwargs.get('batch_size', 1000), pipeline_size)
+            if len(keys) == 0:
+                return pd.DataFrame(columns=list(pkey))
+            return self._parse_keys(table, keys, values, pkey)
+
+        cache_keys, rows = [], []
+        pipe = conn.pipeline(transaction=False)
+        for cache_key in self._scan_unique(conn, self._escape_pattern(table_name) + '-*:counter' + pattern_tail,
+                                           pipeline_size * 10):
+            cache_keys.append(cache_key)
+            pipe.hgetall(cache_key)
+            if len(cache_keys) - len(rows) >= pipeline_size:
+                rows.extend(pipe.execute())
+        rows.extend(pipe.execute())
+        if len(cache_keys) == 0:
+            return pd.DataFrame(columns=list(pkey))
+
+        df = pd.DataFrame([dict([(self._decode(f), self._decode(v)) for f, v in row.items()]) for row in rows])
+        df = self._to_numeric(df, df.columns)
+        return pd.concat([self._parse_row_keys(table, cache_keys, pkey), df], axis=1)
+
+    def load_query(self, query, **kwargs):
+        """
+        load the counters of the keys matching the pattern, with SCAN and pipelined MGET
+        :param query: the glob-style pattern of the keys
+        :param table: the table of the keys in key layout, to rebuild the wide dataframe with *pkey*
+        :param pkey: the columns of the row key, the keys not of the table are skipped if specified
+        :param batch_size: the number of keys in each MGET
+        :param pipeline_size: the number of commands sent in each pipeline
+        :return: the wide dataframe with the pkey columns and the other columns if *pkey* is specified,
+        otherwise the dataframe of the keys and the values
+        """
+        keys, values = self._scan_mget(self.open(), query, kwargs.get('batch_size', 1000),
+                                       kwargs.get('pipeline_size', 100))
+        pkey = kwargs.get('pkey', None)
+        if pkey is None:
+            return self._to_numeric(pd.DataFrame({'key': keys, 'value': values}), ['value'])
+
+        pkey = pkey if isinstance(pkey, tuple) else (pkey,)
+        table = kwargs.get('table', None)
+        assert table, 'table must be set to load dataframe with pkey'
+        table_name, suffix2 = self._split_table(table)
+        head = table_name + '-'
+        tail = ':' + suffix2 if suffix2 else ''
+        matched = [(k, v) for (k, v) in zip(keys, values) if k.startswith(head) and k.endswith(tail)
+                   and ':counter:' in k[len(head):len(k) - len(tail)]]
+        if len(matched) == 0:
+            return pd.DataFrame(columns=list(pkey))
+        return self._parse_keys(table, [k for (k, _) in matched], [v for (_, v) in matched], pkey)
+
+    def open(self):
+        return redis.StrictRedis(connection_pool=redis_pool(self.datasource, self.pool_size,
+                                                            self.health_check_interval))
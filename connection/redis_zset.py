@@ -1,10 +1,39 @@
 import datetime
+import time
+
+import pandas as pd
 import redis
 
 from parade.connection import Connection
 
+from .pool import FlushingPipeline, redis_pool
+
+# increase the scores of the members in ARGV as member, increment pairs
+_INCR_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    redis.call('ZINCRBY', KEYS[1], ARGV[i + 1], ARGV[i])
+end
+return #ARGV / 2
+"""
+
 
 class RedisZSetConnection(Connection):
+    # the max number of connections in the pool
+    pool_size = 50
+    health_check_interval = 0
+    # the days to keep the daily sets, the sets are not bucketed by date and expire at next midnight if not set
+    retention = None
+    # the seconds to cache the rollup sets
+    rollup_ttl = 300
+
+    def initialize(self, context, conf):
+        Connection.initialize(self, context, conf)
+        self.pool_size = conf['pool_size'] if conf.has('pool_size') else self.pool_size
+        self.health_check_interval = conf['health_check_interval'] if conf.has(
+            'health_check_interval') else self.health_check_interval
+        self.retention = conf['retention'] if conf.has('retention') else self.retention
+        self.rollup_ttl = conf['rollup_ttl'] if conf.has('rollup_ttl') else self.rollup_ttl
+
     def _gen_key(self, table, suffix=None, row_key=None):
         if not suffix:
             return table
@@ -17,32 +46,112 @@ class RedisZSetConnection(Connection):
             cache_key += ":" + suffix2
         return cache_key
 
+    def _gen_daily_key(self, table, suffix, date):
+        return self._gen_key(table, suffix=suffix) + ':' + date.strftime('%Y%m%d')
+
     def store(self, df, table, **kwargs):
-        pipe = self.open().pipeline()
+        """
+        increase the scores of the members, the duplicate members are aggregated in the client,
+        and the increments are applied by a lua script in batches
+        :param df: the dict of the suffix and its {member: score}, or the long-format dataframe
+        :param columns: the suffix, member and score columns of the dataframe
+        :param retention: the days to keep the daily sets, overrides the one in conf
+        :param date: the date of the daily sets, today by default
+        :param batch_size: the number of members increased in each script call
+        :param pipeline_size: the number of commands sent in each pipeline
+        :return:
+        """
+        batch_size = kwargs.get('batch_size', 1000)
+        suffix_col, member_col, score_col = kwargs.get('columns', ('suffix', 'member', 'score'))
 
-        # only store set for one day
-        expire_time = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+        if isinstance(df, dict):
+            rows = []
+            for suffix, subset in df.items():
+                assert isinstance(subset, dict), 'not supported data type'
+                rows.extend([(suffix, value, score) for value, score in subset.items()])
+            df = pd.DataFrame(rows, columns=[suffix_col, member_col, score_col])
 
-        assert isinstance(df, dict), 'not supported data type'
+        assert isinstance(df, pd.DataFrame), 'not supported data type'
 
-        for suffix, subset in df.items():
-            cache_key = self._gen_key(table, suffix=suffix)
+        retention = kwargs.get('retention', self.retention)
+        date = kwargs.get('date', datetime.date.today())
+        if retention:
+            # the set of the date is kept for the days of retention
+            expire_time = datetime.datetime.combine(date + datetime.timedelta(days=retention), datetime.time())
+        else:
+            # only store set for one day
+            expire_time = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1),
+                                                    datetime.time())
+        expire_at = int(time.mktime(expire_time.timetuple()))
 
-            assert isinstance(subset, dict), 'not supported data type'
-            for value, score in subset.items():
-                pipe.zincrby(cache_key, value, score)
+        scores = df.groupby([suffix_col, member_col], sort=False)[score_col].sum()
 
-            pipe.expireat(cache_key, expire_time)
+        conn = self.open()
+        script_sha = conn.script_load(_INCR_SCRIPT)
+        pipe = FlushingPipeline(conn, kwargs.get('pipeline_size', 100))
 
-        pipe.execute()
+        for suffix, subset in scores.groupby(level=0, sort=False):
+            cache_key = self._gen_daily_key(table, str(suffix), date) if retention else self._gen_key(
+                table, suffix=str(suffix))
+            members = subset.index.get_level_values(1).tolist()
+            increments = subset.tolist()
+            for start in range(0, len(members), batch_size):
+                args = []
+                for member, increment in zip(members[start:start + batch_size], increments[start:start + batch_size]):
+                    args.append(member)
+                    args.append(increment)
+                pipe.execute_command('EVALSHA', script_sha, 1, cache_key, *args)
 
-    def open(self):
-        host = self.datasource.host if self.datasource.host else 'localhost'
-        port = self.datasource.port if self.datasource.port else 6379
-        db = self.datasource.db if self.datasource.db else 0
+            pipe.execute_command('EXPIREAT', cache_key, expire_at)
+
+        pipe.flush()
+
+    def top(self, table, suffix, k=10, days=1, date=None, retention=None):
+        """
+        get the top members of the daily sets in recent days, the sets are summed up in the server
+        and the rollup set is cached for *rollup_ttl* seconds
+        :param suffix: the suffix of the sets
+        :param k: the number of the top members
+        :param days: the number of the days to roll up, ended at *date*
+        :param date: the last date to roll up, today by default
+        :param retention: the retention the sets are stored with, the one in conf by default,
+        the sets without retention are not bucketed by date and only the current one can be read
+        :return: the dataframe of the members and their scores, in descending order of the scores
+        """
+        suffix = str(suffix)
+        date = date if date is not None else datetime.date.today()
+        retention = retention if retention is not None else self.retention
+        conn = self.open()
 
-        conn = redis.StrictRedis(host=host, port=port, db=db,
-                                 password=self.datasource.password) if self.datasource.password else redis.StrictRedis(
-                host=host, port=port, db=db)
+        if not retention:
+            assert days == 1, 'retention is required to roll up the sets of {} days'.format(days)
+            rollup_key = self._gen_key(table, suffix=suffix)
+        elif days == 1:
+            rollup_key = self._gen_daily_key(table, suffix, date)
+        else:
+            rollup_key = self._gen_daily_key(table, suffix, date) + ':rollup:' + str(days)
+            if not conn.exists(rollup_key):
+                daily_keys = [self._gen_daily_key(table, suffix, date - datetime.timedelta(days=i))
+                              for i in range(days)]
+                pipe = conn.pipeline()
+                pipe.execute_command('ZUNIONSTORE', rollup_key, len(daily_keys), *daily_keys)
+                pipe.expire(rollup_key, self.rollup_ttl)
+                pipe.execute()
 
-        return conn
+        members = conn.zrevrange(rollup_key, 0, k - 1, withscores=True)
+        return pd.DataFrame([(m.decode() if isinstance(m, bytes) else m, score) for (m, score) in members],
+                            columns=['member', 'score'])
+
+    def load(self, table, **kwargs):
+        """
+        load the top members of the daily sets, see *top*
+        :param suffix: the suffix of the sets
+        :return:
+        """
+        assert 'suffix' in kwargs, 'suffix is required to load the sets'
+        return self.top(table, kwargs['suffix'], kwargs.get('k', 10), kwargs.get('days', 1), kwargs.get('date', None),
+                        kwargs.get('retention', None))
+
+    def open(self):
+        return redis.StrictRedis(connection_pool=redis_pool(self.datasource, self.pool_size,
+                                                            self.health_check_interval))
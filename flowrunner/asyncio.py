@@ -0,0 +1,165 @@
+import asyncio
+import threading
+
+from parade.utils.log import logger
+
+from .dag import DAGFlowRunner
+from .trace import traced_call_async
+
+
+class AsyncioRunner(DAGFlowRunner):
+    """
+    the flow runner on a native asyncio event loop, the tasks exposing an *execute_async*
+    coroutine function are awaited in the loop directly, and the blocking ones run in the executor
+    """
+    # most tasks are expected to be io-bound, so much more tasks are executed at the same time
+    concurrency = 256
+    wait_queue = None
+    # the ready async tasks of all flows, ordered by the tasks of their flows in flight,
+    # then by the longest remaining path through the DAG
+    exec_queue = None
+    # the ready blocking tasks of each executor, consumed by as many consumers as the workers of its pool,
+    # so that they are kept in order until a worker is free
+    blocking_queues = None
+    loop = None
+
+    def initialize(self, context, conf):
+        DAGFlowRunner.initialize(self, context, conf)
+
+        loop_ready = threading.Event()
+
+        def engine_loop():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            self.loop.create_task(self.execute_dag_ioloop(loop_ready))
+            self.loop.run_forever()
+
+            # cancel the consumers and the executing tasks once the loop is stopped
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+
+        # use a seperated thread to run the event loop, which executes
+        # all the submitted flows over the shared workers
+        self.loop_thread = threading.Thread(target=engine_loop, name='asyncio-runner', daemon=True)
+        self.loop_thread.start()
+        loop_ready.wait()
+
+    def shutdown(self):
+        """
+        stop the event loop and the worker pools, the executing flows are abandoned
+        :return:
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        DAGFlowRunner.shutdown(self)
+
+    def _run(self, execution):
+        # add to wait queue, waiting to execute
+        self.loop.call_soon_threadsafe(self.wait_queue.put_nowait, execution)
+
+    def _put_ready(self, priority, execution, task_name):
+        task = self.context.task_dict.get(task_name)
+        if task is None or self._is_async(task):
+            self.exec_queue.put_nowait(priority + (execution, task_name))
+        elif getattr(task, 'executor', self.executor) == self.EXECUTOR_PROCESS:
+            self.blocking_queues[self.EXECUTOR_PROCESS].put_nowait(priority + (execution, task_name))
+        else:
+            self.blocking_queues[self.EXECUTOR_THREAD].put_nowait(priority + (execution, task_name))
+
+    def _ready_depth(self):
+        return self.exec_queue.qsize() + sum([q.qsize() for q in self.blocking_queues.values()])
+
+    @staticmethod
+    def _is_async(task):
+        execute_async = getattr(task, 'execute_async', None)
+        return execute_async is not None and asyncio.iscoroutinefunction(execute_async)
+
+    async def _execute_task(self, task_name, task, execution):
+        """
+        await the async execute path of the task in the loop, or run the blocking one in the executor
+        :return: the exception raised (or None), the worker, the start and the end time
+        """
+        if self._is_async(task):
+            return await traced_call_async(task.execute_async, self.context, flow_id=execution.flow_id,
+                                           flow=execution.flow, **execution.kwargs)
+
+        executor = self._get_executor(task)
+        return await self.loop.run_in_executor(executor, self._task_call(executor, task_name, execution))
+
+    async def execute_dag_ioloop(self, loop_ready):
+        """
+        the async process to execute the task DAGs of the submitted flows
+        :param loop_ready: the event set once the queues are created in the loop
+        :return:
+        """
+        self.wait_queue = asyncio.Queue()
+        self.exec_queue = asyncio.PriorityQueue()
+        self.blocking_queues = {
+            self.EXECUTOR_THREAD: asyncio.PriorityQueue(),
+            self.EXECUTOR_PROCESS: asyncio.PriorityQueue(),
+        }
+        loop_ready.set()
+
+        async def _produce_tasks():
+            """
+            the inner async procedure of task producer
+            :return:
+            """
+            # retrieve the flow from wait-queue, and start it without waiting for the executing ones
+            execution = await self.wait_queue.get()
+            try:
+                self._start_flow(execution)
+            except Exception as e:
+                logger.exception(str(e))
+                execution.future.set_exception(e)
+            finally:
+                self.wait_queue.task_done()
+
+        async def _consume_task(exec_queue):
+            """
+            the inner async procedure of task consumers
+            :return:
+            """
+            _, _, _, execution, next_task_name = await exec_queue.get()
+            logger.info("pick up task [{}] of flow {} ...".format(next_task_name, execution.flow.name))
+            error, worker, start_time, end_time = None, None, None, None
+            try:
+                next_task = self.context.task_dict[next_task_name]
+                self._on_task_start(execution, next_task_name)
+
+                logger.info("task {} start executing ...".format(next_task_name))
+                try:
+                    error, worker, start_time, end_time = await self._execute_task(next_task_name, next_task, execution)
+                finally:
+                    self._on_task_stop()
+            except Exception as e:
+                error = e
+            finally:
+                self._on_task_end(execution, next_task_name, error, worker, start_time, end_time)
+                exec_queue.task_done()
+
+        async def consumer(exec_queue):
+            while True:
+                try:
+                    await _consume_task(exec_queue)
+                except Exception as e:
+                    # keep the consumer alive for the other flows
+                    logger.exception(str(e))
+
+        async def producer():
+            while True:
+                await _produce_tasks()
+
+        # the consumers are shared by all the flows, and the references are kept to avoid being collected
+        # the blocking tasks have the consumers as many as the workers of their pools
+        self.consumers = [self.loop.create_task(consumer(self.exec_queue)) for _ in range(self.concurrency)]
+        self.consumers.extend([self.loop.create_task(consumer(self.blocking_queues[self.EXECUTOR_THREAD]))
+                               for _ in range(self.pool_size)])
+        self.consumers.extend([self.loop.create_task(consumer(self.blocking_queues[self.EXECUTOR_PROCESS]))
+                               for _ in range(self.process_pool_size)])
+
+        # we use a single producer within the loop thread
+        await producer()
@@ -0,0 +1,514 @@
+import heapq
+import itertools
+import json
+import os
+import pickle
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+from parade.core.task import Flow
+from parade.flowrunner import FlowRunner
+from parade.utils.log import logger
+
+from .trace import FlowTracer, traced_call
+
+# the context rebuilt in the process worker by *_init_process_worker*
+_process_context = None
+
+
+def _picklable_state(context):
+    """
+    snapshot the attributes of the context to rebuild it in the process workers, the runtime ones
+    which can not be pickled, e.g. the cached flow runner holding the pools and the queues, are reset
+    :param context: the context of the runner
+    :return: the picklable attributes of the context
+    """
+    state = {}
+    for (key, value) in context.__dict__.items():
+        try:
+            pickle.dumps(value)
+            state[key] = value
+        except Exception as e:
+            logger.debug("attribute {} of context is not sent to the process workers: {}".format(key, e))
+            state[key] = None
+    return state
+
+
+def _init_process_worker(context_class, state):
+    global _process_context
+    _process_context = context_class.__new__(context_class)
+    _process_context.__dict__.update(state)
+
+
+def _process_call(task_name, **kwargs):
+    """
+    execute the task in the process worker with the context rebuilt by the initializer,
+    only the names and the arguments are sent to the worker
+    :return: the exception raised (or None), the worker, the start and the end time
+    """
+    task_dict = getattr(_process_context, 'task_dict', None)
+    if task_dict is None or task_name not in task_dict:
+        raise RuntimeError('task {} is not available in the process worker, '
+                           'the task or the context can not be pickled'.format(task_name))
+    return traced_call(task_dict[task_name].execute, _process_context, **kwargs)
+
+
+class FlowExecution(object):
+    """
+    the bookkeeping of a submitted flow run, the runs of different flows
+    are executed at the same time with their own bookkeeping
+    """
+
+    def __init__(self, flow, flow_id=0, resume=False, max_concurrency=None, **kwargs):
+        """
+        :param flow: the flow to run
+        :param flow_id: the id of the flow run
+        :param resume: skip the tasks completed in the last run with the same flow id
+        :param max_concurrency: the max number of tasks of the flow executed at the same time
+        :param kwargs: the arguments passed to the tasks
+        """
+        self.flow = flow
+        self.flow_id = flow_id
+        self.resume = resume
+        self.max_concurrency = max_concurrency
+        self.kwargs = kwargs
+        self.task_names = set(flow.tasks)
+
+        self.executing, self.done = set(), set()
+        # the failed tasks, the tasks skipped for their failed dependencies
+        # and the tasks completed in the last run which are not executed again
+        self.failed, self.skipped, self.resumed = set(), set(), set()
+        # the number of undone upstream task(s) of each task, and the reversed dependencies
+        self.pending_deps, self.downstreams = {}, {}
+        self.critical_paths = {}
+
+        # the ready tasks not dispatched yet, ordered by critical path
+        self.ready = []
+        # the number of the tasks dispatched to the exec-queue and not finished
+        self.dispatched = 0
+        # break the ties of the ready heap in FIFO order
+        self.sequence = itertools.count()
+
+        # resolved once the flow run is finished, can be waited in any thread
+        self.future = Future()
+
+    def index(self, completed=None):
+        """
+        index the dependencies of the tasks to execute
+        :param completed: the tasks completed in the last run, which are passed
+        :return:
+        """
+        if completed:
+            self.resumed.update(completed & self.task_names)
+            self.done.update(self.resumed)
+
+        sched_task_names = self.task_names - self.resumed
+        for sched_task_name in sched_task_names:
+            task_deps = self.flow.deps.get(sched_task_name, set())
+            task_deps = set(filter(lambda x: x in sched_task_names, task_deps))
+            self.pending_deps[sched_task_name] = len(task_deps)
+            for task_dep in task_deps:
+                self.downstreams.setdefault(task_dep, set()).add(sched_task_name)
+
+    def push_ready(self, task_names):
+        for task_name in task_names:
+            heapq.heappush(self.ready, (-self.critical_paths[task_name], next(self.sequence), task_name))
+
+    def pop_ready(self):
+        """
+        pop the most critical ready task if the concurrency cap of the flow is not reached
+        :return: the task name, or None if nothing can be dispatched
+        """
+        if len(self.ready) == 0:
+            return None
+        if self.max_concurrency is not None and self.dispatched >= self.max_concurrency:
+            return None
+        _, _, task_name = heapq.heappop(self.ready)
+        self.dispatched += 1
+        return task_name
+
+    def release_downstreams(self, task_name):
+        """
+        make the downstream tasks ready once their last dependency is done
+        :param task_name: the task just done
+        :return: the tasks become ready
+        """
+        ready_tasks = []
+        for downstream in self.downstreams.get(task_name, set()):
+            self.pending_deps[downstream] -= 1
+            if self.pending_deps[downstream] == 0:
+                logger.info("all dependant task(s) of task {} is done".format(downstream))
+                ready_tasks.append(downstream)
+        self.push_ready(ready_tasks)
+        return ready_tasks
+
+    def skip_downstreams(self, task_name):
+        """
+        mark all the tasks depending on the failed task directly or transitively as skipped
+        :param task_name: the task failed
+        :return: the tasks newly skipped
+        """
+        newly_skipped = set()
+        to_skip = list(self.downstreams.get(task_name, set()))
+        while len(to_skip) > 0:
+            downstream = to_skip.pop()
+            if downstream in self.skipped or downstream in newly_skipped:
+                continue
+            newly_skipped.add(downstream)
+            to_skip.extend(self.downstreams.get(downstream, set()))
+        if len(newly_skipped) > 0:
+            logger.warning("task(s) {} skipped since task {} failed".format(sorted(newly_skipped), task_name))
+            self.skipped.update(newly_skipped)
+        return newly_skipped
+
+    @property
+    def finished(self):
+        return len(self.done) + len(self.failed) + len(self.skipped) == len(self.task_names)
+
+
+class DAGFlowRunner(FlowRunner):
+    """
+    the base of the runners executing the task-DAG of the submitted flows over shared workers,
+    the subclasses drive the ready tasks from the exec-queue with their own event loop
+    """
+    EXECUTOR_THREAD = 'thread'
+    EXECUTOR_PROCESS = 'process'
+
+    # the thread pool to convert block execution of task into async process
+    thread_pool = None
+    # the process pool to execute cpu-bound tasks, created on demand
+    process_pool = None
+    pool_size = 4
+    process_pool_size = None
+    # the number of tasks executed at the same time, derived from the pool size if not specified
+    concurrency = None
+    # the default max number of tasks of a single flow executed at the same time, the concurrency
+    # of the runner if not specified, so that the rest of the ready tasks are kept in the flow ordered
+    # by critical path, instead of queued in the exec-queue ahead of the tasks of other flows
+    flow_concurrency = None
+    # the default executor of tasks, can be overridden by the *executor* attribute of task
+    executor = EXECUTOR_THREAD
+    # the number of recent durations kept for each task
+    duration_history = 10
+    # the number of the task records and the gauge samples kept by the tracer
+    trace_limit = 100000
+
+    def initialize(self, context, conf):
+        self.context = context
+        self.conf = conf
+        # return the future of the flow run from *submit* instead of waiting for it
+        self.detach = self.conf['detach'] if self.conf.has('detach') else False
+
+        self.pool_size = self.conf['pool_size'] if self.conf.has('pool_size') else self.pool_size
+        self.process_pool_size = self.conf['process_pool_size'] if self.conf.has(
+            'process_pool_size') else os.cpu_count()
+        self.executor = self.conf['executor'] if self.conf.has('executor') else self.executor
+        assert self.executor in (self.EXECUTOR_THREAD, self.EXECUTOR_PROCESS), \
+            'executor {} not supported'.format(self.executor)
+        # keep all workers of the default pool busy if the concurrency is not specified
+        default_concurrency = self.concurrency
+        if default_concurrency is None:
+            default_concurrency = self.process_pool_size if self.executor == self.EXECUTOR_PROCESS else self.pool_size
+        self.concurrency = self.conf['concurrency'] if self.conf.has('concurrency') else default_concurrency
+        self.flow_concurrency = self.conf['flow_concurrency'] if self.conf.has(
+            'flow_concurrency') else self.flow_concurrency
+        if self.flow_concurrency is None:
+            self.flow_concurrency = self.concurrency
+
+        self.thread_pool = ThreadPoolExecutor(self.pool_size)
+
+        # the wall-clock durations of the task executions in recent runs
+        self.duration_file = os.path.join(self.context.workdir, 'runner', 'durations.json')
+        self.task_durations = self._load_durations()
+        self.checkpoint_dir = os.path.join(self.context.workdir, 'runner', 'checkpoints')
+
+        self.tracer = FlowTracer(self.conf['trace_limit'] if self.conf.has('trace_limit') else self.trace_limit)
+        # the number of the tasks executing in the workers
+        self.busy = 0
+
+        # break the ties of the exec-queue in FIFO order
+        self.sequence = itertools.count()
+
+    def shutdown(self):
+        """
+        stop the worker pools, the executing flows are abandoned
+        :return:
+        """
+        self.thread_pool.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
+    def trace_summary(self):
+        """
+        the timing of the finished task executions
+        :return: the summary dataframe
+        """
+        return self.tracer.summary()
+
+    def export_trace(self, path):
+        """
+        export the task executions and runner gauges in chrome trace-event format
+        :param path: the json file to write
+        :return:
+        """
+        self.tracer.export_chrome_trace(path)
+
+    def _gauge(self):
+        self.tracer.gauge(self.busy, self.concurrency, self._ready_depth())
+
+    def _get_executor(self, task):
+        """
+        pick the pool to execute the task, a process pool requires the task and
+        the context to be picklable, and the state changed in the task is not sent back
+        :param task: the task to execute
+        :return:
+        """
+        executor = getattr(task, 'executor', self.executor)
+        if executor != self.EXECUTOR_PROCESS:
+            return self.thread_pool
+        if self.process_pool is None:
+            # the context holds the runner itself, so it is rebuilt in each worker instead of sent with the tasks
+            self.process_pool = ProcessPoolExecutor(self.process_pool_size, initializer=_init_process_worker,
+                                                    initargs=(type(self.context), _picklable_state(self.context)))
+        return self.process_pool
+
+    def _task_call(self, executor, task_name, execution):
+        """
+        build the call of the task to run in the executor
+        :return: the function returning the exception raised (or None), the worker, the start and the end time
+        """
+        if executor is self.process_pool:
+            return partial(_process_call, task_name, flow_id=execution.flow_id, flow=execution.flow,
+                           **execution.kwargs)
+        return partial(traced_call, self.context.task_dict[task_name].execute, self.context,
+                       flow_id=execution.flow_id, flow=execution.flow, **execution.kwargs)
+
+    def _load_durations(self):
+        if not os.path.exists(self.duration_file):
+            return {}
+        try:
+            with open(self.duration_file) as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("task durations in {} corrupted, ignored".format(self.duration_file))
+            return {}
+
+    def _save_durations(self):
+        os.makedirs(os.path.dirname(self.duration_file), exist_ok=True)
+        tmp_file = self.duration_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.task_durations, f)
+        os.replace(tmp_file, self.duration_file)
+
+    def _record_duration(self, task_name, duration):
+        durations = self.task_durations.setdefault(task_name, [])
+        durations.append(duration)
+        del durations[:-self.duration_history]
+
+    def _checkpoint_file(self, execution):
+        return os.path.join(self.checkpoint_dir, '{}-{}.json'.format(execution.flow.name, execution.flow_id))
+
+    def _load_checkpoint(self, execution):
+        """
+        load the tasks completed in the last run of the flow
+        :return: the names of the completed tasks
+        """
+        checkpoint_file = self._checkpoint_file(execution)
+        if not os.path.exists(checkpoint_file):
+            return set()
+        with open(checkpoint_file) as f:
+            return set(json.load(f)['done'])
+
+    def _save_checkpoint(self, execution):
+        checkpoint_file = self._checkpoint_file(execution)
+        tmp_file = checkpoint_file + '.tmp'
+        try:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump({
+                    'flow': execution.flow.name,
+                    'flow_id': execution.flow_id,
+                    'done': sorted(execution.done),
+                    'failed': sorted(execution.failed),
+                    'skipped': sorted(execution.skipped),
+                }, f)
+            os.replace(tmp_file, checkpoint_file)
+        except OSError as e:
+            # the flow run goes on without checkpoint
+            logger.warning("checkpoint of flow {} not saved: {}".format(execution.flow.name, e))
+
+    def _critical_paths(self, pending_deps, downstreams):
+        """
+        estimate the longest remaining path through the DAG from each task with the recorded durations,
+        the tasks never executed are assumed to take the average duration of the others
+        :param pending_deps: the number of dependencies of each task
+        :param downstreams: the tasks depending on each task
+        :return: the estimated critical path length of each task
+        """
+        estimates = dict([(task_name, sum(durations) / len(durations))
+                          for (task_name, durations) in self.task_durations.items()
+                          if task_name in pending_deps and len(durations) > 0])
+        default_estimate = sum(estimates.values()) / len(estimates) if len(estimates) > 0 else 1.0
+
+        # sort the tasks topologically, and accumulate the path lengths from the sinks
+        in_degrees = dict(pending_deps)
+        topo_order = [task_name for (task_name, in_degree) in in_degrees.items() if in_degree == 0]
+        for task_name in topo_order:
+            for downstream in downstreams.get(task_name, set()):
+                in_degrees[downstream] -= 1
+                if in_degrees[downstream] == 0:
+                    topo_order.append(downstream)
+        assert len(topo_order) == len(pending_deps), 'circular dependencies found in flow'
+
+        critical_paths = {}
+        for task_name in reversed(topo_order):
+            path_after = max([critical_paths[x] for x in downstreams.get(task_name, set())], default=0)
+            critical_paths[task_name] = estimates.get(task_name, default_estimate) + path_after
+        return critical_paths
+
+    def submit(self, flow, flow_id=0, resume=False, max_concurrency=None, **kwargs):
+        """
+        execute a set of tasks with DAG-topology into consideration,
+        the flows submitted from different threads are executed at the same time
+        :param flow: the flow to run
+        :param flow_id: the id of the flow run, the completed tasks are checkpointed with it
+        :param resume: skip the tasks completed in the last run with the same flow id
+        :param max_concurrency: the max number of tasks of the flow executed at the same time
+        :return: whether all the tasks succeeded, or the future of it in detach mode
+        """
+
+        assert isinstance(flow, Flow)
+        for task_name in flow.tasks:
+            assert task_name in self.context.task_dict, 'task {} not found'.format(task_name)
+
+        if max_concurrency is None:
+            max_concurrency = self.flow_concurrency
+        execution = FlowExecution(flow, flow_id, resume=resume, max_concurrency=max_concurrency, **kwargs)
+
+        self._run(execution)
+        if self.detach:
+            return execution.future
+        return execution.future.result()
+
+    def _run(self, execution):
+        """
+        hand over the flow run to the event loop of the runner, which calls *_start_flow* on it
+        :param execution: the flow run
+        :return:
+        """
+        raise NotImplementedError
+
+    def _put_ready(self, priority, execution, task_name):
+        """
+        put the task into the exec-queue of the runner, the smaller priority comes first
+        :param priority: the (tasks of the flow in flight, negative critical path, sequence) of the task
+        :return:
+        """
+        raise NotImplementedError
+
+    def _ready_depth(self):
+        """
+        the number of the tasks waiting in the exec-queue
+        :return:
+        """
+        raise NotImplementedError
+
+    def _dispatch(self, execution):
+        """
+        put the ready tasks of the flow into the exec-queue, within the concurrency cap of the flow,
+        the tasks are ordered by the number of the tasks of their flows in flight first to share the workers
+        fairly among the flows, so that a small flow is not starved by the wide ones, then by critical path
+        :param execution: the flow run
+        :return:
+        """
+        while True:
+            in_flight = execution.dispatched
+            task_name = execution.pop_ready()
+            if task_name is None:
+                break
+            self._put_ready((in_flight, -execution.critical_paths[task_name], next(self.sequence)),
+                            execution, task_name)
+        self._gauge()
+
+    def _start_flow(self, execution):
+        """
+        index the task-DAG of the flow and dispatch the tasks without dependency
+        :param execution: the flow run
+        :return:
+        """
+        completed = self._load_checkpoint(execution) if execution.resume else None
+        execution.index(completed)
+        if execution.resume:
+            logger.info("resume flow {}, {} completed task(s) passed".format(execution.flow.name,
+                                                                              len(execution.resumed)))
+        execution.critical_paths.update(self._critical_paths(execution.pending_deps, execution.downstreams))
+
+        self.tracer.queued(execution.flow.name, execution.flow_id, execution.task_names - execution.resumed)
+        if execution.finished:
+            self._finish_flow(execution)
+            return
+
+        # only the tasks without dependency are ready to execute at first
+        ready_tasks = [x for (x, y) in execution.pending_deps.items() if y == 0]
+        execution.push_ready(ready_tasks)
+        for task_name in ready_tasks:
+            self.tracer.ready(execution.flow.name, execution.flow_id, task_name)
+        self._dispatch(execution)
+
+    def _finish_flow(self, execution):
+        try:
+            self._save_durations()
+        except OSError as e:
+            logger.warning("task durations not saved: {}".format(e))
+
+        if len(execution.failed) > 0:
+            logger.error("flow {} failed, task(s) {} failed, task(s) {} skipped, rerun with resume to continue".format(
+                execution.flow.name, sorted(execution.failed), sorted(execution.skipped)))
+        # the flow run may have been failed by an error of the runner already
+        if not execution.future.done():
+            execution.future.set_result(len(execution.failed) == 0)
+
+    def _on_task_start(self, execution, task_name):
+        execution.executing.add(task_name)
+        self.busy += 1
+        self._gauge()
+
+    def _on_task_stop(self):
+        self.busy -= 1
+        self._gauge()
+
+    def _on_task_end(self, execution, task_name, error=None, worker=None, start_time=None, end_time=None):
+        """
+        record the outcome of the task, release or skip its downstream tasks and dispatch the ready ones
+        :param execution: the flow run
+        :param task_name: the task finished
+        :param error: the exception raised by the task, None if succeeded
+        :param worker: the worker executed the task
+        :param start_time: the time the task started in the worker
+        :param end_time: the time the task ended in the worker
+        :return:
+        """
+        flow_name, flow_id = execution.flow.name, execution.flow_id
+        if error is None:
+            logger.info("task {} Executed successfully".format(task_name))
+            self._record_duration(task_name, end_time - start_time)
+            self.tracer.finished(flow_name, flow_id, task_name, FlowTracer.OUTCOME_SUCCESS,
+                                 worker, start_time, end_time)
+            execution.done.add(task_name)
+            for ready_task in execution.release_downstreams(task_name):
+                self.tracer.ready(flow_name, flow_id, ready_task)
+        else:
+            # the errors reported from remote workers carry no traceback
+            logger.error(str(error), exc_info=error if error.__traceback__ is not None else None)
+            self.tracer.finished(flow_name, flow_id, task_name, FlowTracer.OUTCOME_FAILED,
+                                 worker, start_time, end_time)
+            execution.failed.add(task_name)
+            for skipped_task in execution.skip_downstreams(task_name):
+                self.tracer.finished(flow_name, flow_id, skipped_task, FlowTracer.OUTCOME_SKIPPED)
+
+        execution.dispatched -= 1
+        self._save_checkpoint(execution)
+        if execution.finished:
+            self._finish_flow(execution)
+        else:
+            self._dispatch(execution)
@@ -0,0 +1,423 @@
+import json
+import queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from parade.core.task import Flow
+from parade.utils.log import logger
+
+from .dag import DAGFlowRunner
+from .trace import traced_call
+
+
+def _open_redis(conf):
+    host = conf['host'] if conf.has('host') else 'localhost'
+    port = conf['port'] if conf.has('port') else 6379
+    db = conf['db'] if conf.has('db') else 0
+
+    conn = redis.StrictRedis(host=host, port=port, db=db,
+                             password=conf['password']) if conf.has('password') else redis.StrictRedis(
+            host=host, port=port, db=db)
+
+    return conn
+
+
+# move the most critical ready task into the running set, with the lease deadline as its score
+_CLAIM_SCRIPT = """
+local msgs = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #msgs == 0 then
+    return nil
+end
+local now = redis.call('TIME')
+redis.call('ZREM', KEYS[1], msgs[1])
+redis.call('ZADD', KEYS[2], tonumber(now[1]) + tonumber(ARGV[1]), msgs[1])
+return msgs[1]
+"""
+
+# extend the leases of the tasks still running, the ones already reaped are not brought back
+_HEARTBEAT_SCRIPT = """
+local now = redis.call('TIME')
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[1], 'XX', tonumber(now[1]) + tonumber(ARGV[1]), ARGV[i])
+end
+return #ARGV - 1
+"""
+
+# release the lease and report the result to the runner
+_COMPLETE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('LPUSH', KEYS[2], ARGV[2])
+return 1
+"""
+
+# find the tasks whose lease expired
+_EXPIRED_SCRIPT = """
+local now = redis.call('TIME')
+return redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', tonumber(now[1]))
+"""
+
+
+class RedisRunner(DAGFlowRunner):
+    """
+    the flow runner publishing the ready tasks into a redis-backed queue, which are consumed by
+    the *RedisTaskWorker* on any host, the workers report the results back to release the dependent tasks,
+    the task whose lease is not renewed by the heartbeat of its worker is retried
+    """
+    # the prefix of the redis keys shared by the runners and the workers
+    prefix = 'parade:runner'
+    # the seconds a claimed task is kept by its worker without heartbeat
+    lease = 60
+    # the times a task is retried after its lease expired
+    max_retries = 2
+
+    def initialize(self, context, conf):
+        DAGFlowRunner.initialize(self, context, conf)
+        self.prefix = self.conf['prefix'] if self.conf.has('prefix') else self.prefix
+        self.lease = self.conf['lease'] if self.conf.has('lease') else self.lease
+        self.max_retries = self.conf['max_retries'] if self.conf.has('max_retries') else self.max_retries
+        # the workers are not known to the runner, so the flows are not capped by default
+        self.flow_concurrency = self.conf['flow_concurrency'] if self.conf.has('flow_concurrency') else None
+
+        self.redis = _open_redis(self.conf)
+        self.runner_id = uuid.uuid4().hex
+        self.ready_key = self.prefix + ':ready'
+        self.running_key = self.prefix + ':running'
+        self.flow_key = self.prefix + ':flows'
+        self.result_key = self.prefix + ':results:' + self.runner_id
+        self.expired_script = self.redis.register_script(_EXPIRED_SCRIPT)
+
+        # the flows submitted, waiting to be started by the coordinator
+        self.wait_queue = queue.Queue()
+        # the tasks published and not reported, indexed by the message id
+        self.inflight = {}
+        # the tasks failed to publish, which are published again by the coordinator
+        self.unpublished = []
+        # the time the published messages are found in neither the ready set nor the running set
+        self.missing = {}
+        # the published messages not claimed by a worker as last seen, to sample the ready depth without redis
+        self.unclaimed = set()
+        self.stopped = threading.Event()
+
+        # the bookkeeping of the flows is only touched by the coordinator thread
+        self.loop_thread = threading.Thread(target=self.coordinate, name='redis-runner', daemon=True)
+        self.loop_thread.start()
+
+    def shutdown(self):
+        """
+        stop the coordinator, the executing flows are abandoned
+        :return:
+        """
+        self.stopped.set()
+        self.loop_thread.join()
+        DAGFlowRunner.shutdown(self)
+
+    def _run(self, execution):
+        # add to wait queue, and wake up the coordinator blocked on the results
+        self.wait_queue.put(execution)
+        self.redis.lpush(self.result_key, json.dumps({}))
+
+    def _flow_field(self, execution):
+        return '{}:{}:{}'.format(self.runner_id, execution.flow.name, execution.flow_id)
+
+    def _start_flow(self, execution):
+        # publish the flow definition once, the task messages refer to it
+        self.redis.hset(self.flow_key, self._flow_field(execution), json.dumps({
+            'name': execution.flow.name,
+            'tasks': list(execution.flow.tasks),
+            'deps': dict([(t, list(d)) for (t, d) in execution.flow.deps.items()]),
+        }))
+        DAGFlowRunner._start_flow(self, execution)
+
+    def _finish_flow(self, execution):
+        DAGFlowRunner._finish_flow(self, execution)
+        try:
+            self.redis.hdel(self.flow_key, self._flow_field(execution))
+        except redis.RedisError as e:
+            logger.warning("definition of flow {} not removed: {}".format(execution.flow.name, e))
+
+    def _put_ready(self, priority, execution, task_name, attempt=0):
+        if attempt == 0:
+            self._on_task_start(execution, task_name)
+        self._publish(priority, execution, task_name, attempt)
+
+    def _publish(self, priority, execution, task_name, attempt):
+        """
+        publish the task into the ready set, the task is tracked as inflight only once published,
+        otherwise it is kept to publish again by the coordinator
+        :return:
+        """
+        msg_id = uuid.uuid4().hex
+        msg = json.dumps({
+            'id': msg_id,
+            'reply_to': self.result_key,
+            'flow': self._flow_field(execution),
+            'flow_id': execution.flow_id,
+            'task': task_name,
+            'kwargs': execution.kwargs,
+            'attempt': attempt,
+        })
+        try:
+            self.redis.execute_command('ZADD', self.ready_key, self._score(priority), msg)
+        except redis.RedisError as e:
+            logger.warning("task {} not published, retry later: {}".format(task_name, e))
+            self.unpublished.append((priority, execution, task_name, attempt))
+            return
+        self.inflight[msg_id] = (priority, execution, task_name, attempt, msg)
+        self.unclaimed.add(msg_id)
+
+    @staticmethod
+    def _score(priority):
+        """
+        fold the priority into the score of the ready set, the tasks in flight of the flow come first,
+        and the negative critical path is mapped into (-1, 0] to order the tasks with the same tasks in flight
+        """
+        in_flight, neg_critical_path = priority[0], priority[1]
+        return in_flight + neg_critical_path / (1.0 - neg_critical_path)
+
+    def _republish(self):
+        unpublished, self.unpublished = self.unpublished, []
+        for (priority, execution, task_name, attempt) in unpublished:
+            self._publish(priority, execution, task_name, attempt)
+
+    def _ready_depth(self):
+        # the gauges are sampled in the middle of the bookkeeping, which must not fail on redis errors
+        return len(self.unclaimed)
+
+    def _on_result(self, result):
+        if 'id' not in result:
+            # the wake-up signal for the submitted flows
+            return
+        inflight = self.inflight.pop(result['id'], None)
+        self.missing.pop(result['id'], None)
+        self.unclaimed.discard(result['id'])
+        if inflight is None:
+            logger.warning("result of task {} ignored since its lease expired".format(result['task']))
+            return
+        _, execution, task_name, _, _ = inflight
+        error = RuntimeError(result['error']) if result['error'] is not None else None
+        self._end_task(execution, task_name, error, result['worker'], result['start'], result['end'])
+
+    def _end_task(self, execution, task_name, error=None, worker=None, start_time=None, end_time=None):
+        """
+        handle the end of the task, the flow run fails instead of hanging if the handling goes wrong
+        :return:
+        """
+        try:
+            self._on_task_stop()
+            self._on_task_end(execution, task_name, error, worker, start_time, end_time)
+        except Exception as e:
+            logger.exception(str(e))
+            if not execution.future.done():
+                execution.future.set_exception(e)
+
+    def _retry_task(self, inflight, reason):
+        priority, execution, task_name, attempt, _ = inflight
+        if attempt < self.max_retries:
+            logger.warning("{} task {}, retry it".format(reason, task_name))
+            self._publish(priority, execution, task_name, attempt + 1)
+        else:
+            self._end_task(execution, task_name, RuntimeError(
+                '{} task {} after {} retries'.format(reason, task_name, attempt)))
+
+    def _reap(self):
+        """
+        retry the tasks of this runner whose lease expired, or whose message is lost
+        :return:
+        """
+        for msg in self.expired_script(keys=[self.running_key]):
+            msg = msg.decode() if isinstance(msg, bytes) else msg
+            payload = json.loads(msg)
+            if payload['id'] not in self.inflight:
+                continue
+            # only one party removes the message, the worker may still report it in time
+            if self.redis.zrem(self.running_key, msg) == 0:
+                continue
+            self.unclaimed.discard(payload['id'])
+            self._retry_task(self.inflight.pop(payload['id']), 'lease expired of')
+
+        # the message in neither set is reported, or lost with its result, e.g. by a failover of redis,
+        # it is retried if its result does not arrive within a lease
+        msg_ids = list(self.inflight.keys())
+        pipe = self.redis.pipeline(transaction=False)
+        for msg_id in msg_ids:
+            pipe.zscore(self.ready_key, self.inflight[msg_id][4])
+            pipe.zscore(self.running_key, self.inflight[msg_id][4])
+        scores = pipe.execute()
+        now = time.time()
+        for (i, msg_id) in enumerate(msg_ids):
+            if msg_id not in self.inflight:
+                continue
+            if scores[2 * i] is None:
+                self.unclaimed.discard(msg_id)
+            else:
+                self.unclaimed.add(msg_id)
+            if scores[2 * i] is not None or scores[2 * i + 1] is not None:
+                self.missing.pop(msg_id, None)
+                continue
+            if now - self.missing.setdefault(msg_id, now) >= self.lease:
+                del self.missing[msg_id]
+                self.unclaimed.discard(msg_id)
+                self._retry_task(self.inflight.pop(msg_id), 'message lost of')
+
+    def coordinate(self):
+        """
+        the coordinator loop, which starts the submitted flows and handles the reported results
+        :return:
+        """
+        last_reap = 0
+        while not self.stopped.is_set():
+            try:
+                while not self.wait_queue.empty():
+                    execution = self.wait_queue.get()
+                    try:
+                        self._start_flow(execution)
+                    except Exception as e:
+                        logger.exception(str(e))
+                        if not execution.future.done():
+                            execution.future.set_exception(e)
+
+                if len(self.unpublished) > 0:
+                    self._republish()
+
+                reply = self.redis.brpop(self.result_key, timeout=1)
+                if reply is not None:
+                    self._on_result(json.loads(reply[1]))
+
+                if time.time() - last_reap >= min(self.lease / 3, 10):
+                    self._reap()
+                    last_reap = time.time()
+            except redis.RedisError as e:
+                logger.exception(str(e))
+                time.sleep(1)
+            except Exception as e:
+                # keep the coordinator alive for the other flows
+                logger.exception(str(e))
+
+
+class RedisTaskWorker(object):
+    """
+    the worker executing the tasks published by the *RedisRunner*, can be started on any host
+    with the same workspace, the tasks run in a thread pool and the leases are kept by heartbeat
+    """
+
+    def __init__(self, context, conf):
+        """
+        :param context: the context holding the tasks to execute
+        :param conf: the runner conf, with the redis connection, *prefix* and *lease*
+        """
+        self.context = context
+        self.prefix = conf['prefix'] if conf.has('prefix') else RedisRunner.prefix
+        self.lease = conf['lease'] if conf.has('lease') else RedisRunner.lease
+        self.workers = conf['workers'] if conf.has('workers') else 4
+        # the seconds to wait before claiming again if no task is ready
+        self.poll_interval = conf['poll_interval'] if conf.has('poll_interval') else 0.5
+        # the times to report the result, with exponential backoff from *report_backoff* seconds
+        self.report_retries = conf['report_retries'] if conf.has('report_retries') else 3
+        self.report_backoff = conf['report_backoff'] if conf.has('report_backoff') else 1
+
+        self.redis = _open_redis(conf)
+        self.ready_key = self.prefix + ':ready'
+        self.running_key = self.prefix + ':running'
+        self.flow_key = self.prefix + ':flows'
+        self.claim_script = self.redis.register_script(_CLAIM_SCRIPT)
+        self.heartbeat_script = self.redis.register_script(_HEARTBEAT_SCRIPT)
+        self.complete_script = self.redis.register_script(_COMPLETE_SCRIPT)
+
+        self.worker_id = '{}/{}'.format(socket.gethostname(), uuid.uuid4().hex[:8])
+        # the messages claimed and not completed
+        self.claimed = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.lease / 3):
+            with self.lock:
+                claimed = list(self.claimed)
+            if len(claimed) == 0:
+                continue
+            try:
+                self.heartbeat_script(keys=[self.running_key], args=[self.lease] + claimed)
+            except redis.RedisError as e:
+                logger.exception(str(e))
+
+    def _load_flow(self, flow_field):
+        flow = json.loads(self.redis.hget(self.flow_key, flow_field))
+        return Flow(flow['name'], flow['tasks'], dict([(t, set(d)) for (t, d) in flow['deps'].items()]))
+
+    def _execute(self, msg):
+        payload = json.loads(msg)
+        error, worker, start_time, end_time = None, self.worker_id, None, None
+        try:
+            task = self.context.task_dict[payload['task']]
+            flow = self._load_flow(payload['flow'])
+            logger.info("task {} start executing ...".format(payload['task']))
+            e, worker, start_time, end_time = traced_call(task.execute, self.context, flow_id=payload['flow_id'],
+                                                          flow=flow, **payload['kwargs'])
+            if e is not None:
+                error = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+            worker = self.worker_id + '/' + worker
+        except Exception as e:
+            logger.exception(str(e))
+            error = str(e)
+
+        result = json.dumps({'id': payload['id'], 'task': payload['task'], 'error': error,
+                             'worker': worker, 'start': start_time, 'end': end_time})
+        try:
+            for retry_time in range(0, self.report_retries):
+                try:
+                    self.complete_script(keys=[self.running_key, payload['reply_to']], args=[msg, result])
+                    return
+                except redis.RedisError as e:
+                    if retry_time == self.report_retries - 1:
+                        raise
+                    logger.warning("failed to report task {}, retry it: {}".format(payload['task'], e))
+                    time.sleep(self.report_backoff * 2 ** retry_time)
+        finally:
+            # stop the heartbeat in any case, the runner retries the task once its lease expired
+            with self.lock:
+                self.claimed.discard(msg)
+
+    def run(self):
+        """
+        claim and execute the ready tasks until stopped
+        :return:
+        """
+        heartbeat = threading.Thread(target=self._heartbeat, name='redis-worker-heartbeat', daemon=True)
+        heartbeat.start()
+        slots = threading.Semaphore(self.workers)
+
+        def _execute_in_slot(msg):
+            try:
+                self._execute(msg)
+            except Exception as e:
+                logger.exception(str(e))
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            while not self.stopped.is_set():
+                slots.acquire()
+                try:
+                    msg = self.claim_script(keys=[self.ready_key, self.running_key], args=[self.lease])
+                except redis.RedisError as e:
+                    logger.exception(str(e))
+                    msg = None
+                if msg is None:
+                    slots.release()
+                    self.stopped.wait(self.poll_interval)
+                    continue
+
+                msg = msg.decode() if isinstance(msg, bytes) else msg
+                with self.lock:
+                    self.claimed.add(msg)
+                pool.submit(_execute_in_slot, msg)
+        heartbeat.join()
@@ -1,60 +1,56 @@
 import threading
-from concurrent.futures import ThreadPoolExecutor
 from tornado import gen, queues, ioloop
 
-from parade.core.task import Flow
-from parade.flowrunner import FlowRunner
 from parade.utils.log import logger
 
+from .dag import DAGFlowRunner
 
-class TornadoRunner(FlowRunner):
-    # the thread pool to convert block execution of task into async process
-    thread_pool = ThreadPoolExecutor(4)
-    wait_queue = queues.Queue()
-    exec_queue = queues.Queue()
-    executing_flow = None
-    executing_flow_id = 0
-    kwargs = {}
+
+class TornadoRunner(DAGFlowRunner):
+    wait_queue = None
+    # the ready tasks of all flows, ordered by the tasks of their flows in flight,
+    # then by the longest remaining path through the DAG
+    exec_queue = None
+    io_loop = None
 
     def initialize(self, context, conf):
-        self.context = context
-        detach = False
+        DAGFlowRunner.initialize(self, context, conf)
+
+        self.wait_queue = queues.Queue()
+        self.exec_queue = queues.PriorityQueue()
+
+        loop_ready = threading.Event()
 
         def engine_loop():
-            _ioloop = ioloop.IOLoop.current()
-            _ioloop.add_callback(self.daemon_loop)
-            _ioloop.start()
-
-        # if the detached mode is enabled
-        # use a seperated thread to boot the io-loop
-        self.loop_thread = None
-        if detach:
-            logger.debug("engine running in detach mode")
-            self.loop_thread = threading.Thread(target=engine_loop)
-            self.loop_thread.start()
-
-    def submit(self, flow, flow_id=0, **kwargs):
+            self.io_loop = ioloop.IOLoop()
+            self.io_loop.add_callback(self.daemon_loop)
+            self.io_loop.add_callback(loop_ready.set)
+            self.io_loop.start()
+
+        # use a seperated thread to boot the io-loop, which executes
+        # all the submitted flows over the shared worker pool
+        self.loop_thread = threading.Thread(target=engine_loop, name='tornado-runner', daemon=True)
+        self.loop_thread.start()
+        loop_ready.wait()
+
+    def shutdown(self):
         """
-        execute a set of tasks with DAG-topology into consideration
-        :param task_names: the tasks to form DAG
+        stop the io-loop and the worker pools, the executing flows are abandoned
         :return:
         """
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.loop_thread.join()
+        DAGFlowRunner.shutdown(self)
 
-        assert isinstance(flow, Flow)
-        self.executing_flow = flow
-        self.executing_flow_id = flow_id
-        self.kwargs = kwargs
-
-        self._run()
-        io_loop = ioloop.IOLoop.current()
-        io_loop.run_sync(self.execute_dag_ioloop)
+    def _run(self, execution):
+        # add to wait queue, waiting to execute
+        self.io_loop.add_callback(self.wait_queue.put, execution)
 
-    def _run(self):
-        for task_name in self.executing_flow.tasks:
-            assert task_name in self.context.task_dict, 'task {} not found'.format(task_name)
+    def _put_ready(self, priority, execution, task_name):
+        self.exec_queue.put(priority + (execution, task_name))
 
-        # add to wait queue, waiting to execute
-        self.wait_queue.put(set(self.executing_flow.tasks))
+    def _ready_depth(self):
+        return self.exec_queue.qsize()
 
     @gen.coroutine
     def daemon_loop(self):
@@ -63,10 +59,9 @@ class TornadoRunner(FlowRunner):
     @gen.coroutine
     def execute_dag_ioloop(self):
         """
-        the async process to execute task DAG
+        the async process to execute the task DAGs of the submitted flows
         :return:
         """
-        executing, done = set(), set()
 
         @gen.coroutine
         def _produce_tasks():
@@ -74,18 +69,15 @@ class TornadoRunner(FlowRunner):
             the inner async procedure of task producer
             :return:
             """
-            # wait until all tasks in executing queue are done
-            yield self.exec_queue.join()
-
-            # reset the *executing* and *done* set
-            executing.clear()
-            done.clear()
-
-            # retrieve the task-DAG from wait-queue to exec-queue
-            sched_task_names = yield self.wait_queue.get()
-            for sched_task_name in sched_task_names:
-                self.exec_queue.put(sched_task_name)
-            self.wait_queue.task_done()
+            # retrieve the flow from wait-queue, and start it without waiting for the executing ones
+            execution = yield self.wait_queue.get()
+            try:
+                self._start_flow(execution)
+            except Exception as e:
+                logger.exception(str(e))
+                execution.future.set_exception(e)
+            finally:
+                self.wait_queue.task_done()
 
         @gen.coroutine
         def _consume_task():
@@ -93,58 +85,44 @@ class TornadoRunner(FlowRunner):
             the inner async procedure of task consumers
             :return:
             """
-            next_task_name = yield self.exec_queue.get()
-            logger.info("pick up task [{}] ...".format(next_task_name))
+            _, _, _, execution, next_task_name = yield self.exec_queue.get()
+            logger.info("pick up task [{}] of flow {} ...".format(next_task_name, execution.flow.name))
+            error, worker, start_time, end_time = None, None, None, None
             try:
-                if next_task_name in executing:
-                    logger.info("task [{}] is executing, pass ...".format(next_task_name))
-                    return
-
                 next_task = self.context.task_dict[next_task_name]
-                task_deps = self.executing_flow.deps.get(next_task_name, set())
-                # if len(task_deps) > 0:
-                #     logger.debug(
-                #         "task [{}] has {} dependant task(s), {}".format(next_task_name, len(task_deps), task_deps))
-                done_deps = set(filter(lambda x: x in done, task_deps))
-
-                if len(task_deps) == len(done_deps):
-                    # all dependencies are done
-                    # submit the task to threading pool to execute
-                    if len(task_deps) > 0:
-                        logger.info("all dependant task(s) of task {} is done".format(next_task_name))
-                    executing.add(next_task_name)
-
-                    logger.info("task {} start executing ...".format(next_task_name))
-                    yield self.thread_pool.submit(next_task.execute, self.context, flow_id=self.executing_flow_id,
-                                                  flow=self.executing_flow, **self.kwargs)
-                    logger.info("task {} Executed successfully".format(next_task_name))
-                    done.add(next_task_name)
-
-                else:
-                    # otherwise, re-put the task into the end of the queue
-                    # sleep for 1 second
-                    self.exec_queue.put(next_task_name)
-                    yield gen.sleep(1)
+                self._on_task_start(execution, next_task_name)
+
+                # submit the task to the thread/process pool to execute
+                logger.info("task {} start executing ...".format(next_task_name))
+                executor = self._get_executor(next_task)
+                try:
+                    error, worker, start_time, end_time = yield executor.submit(
+                        self._task_call(executor, next_task_name, execution))
+                finally:
+                    self._on_task_stop()
             except Exception as e:
-                logger.exception(str(e))
+                error = e
             finally:
+                self._on_task_end(execution, next_task_name, error, worker, start_time, end_time)
                 self.exec_queue.task_done()
 
         @gen.coroutine
         def consumer():
             while True:
-                yield _consume_task()
+                try:
+                    yield _consume_task()
+                except Exception as e:
+                    # keep the consumer alive for the other flows
+                    logger.exception(str(e))
 
         @gen.coroutine
         def producer():
             while True:
                 yield _produce_tasks()
 
-        for _ in range(2):
+        # the consumers are shared by all the flows
+        for _ in range(self.concurrency):
             consumer()
 
-        # we use a single producer within the main-thread
-        producer()
-
-        yield self.exec_queue.join()
-        assert executing == done
+        # we use a single producer within the io-loop thread
+        yield producer()
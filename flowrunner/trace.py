@@ -0,0 +1,184 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+
+def current_worker():
+    """
+    identify the worker executing the current call
+    :return: the process id and the thread name of the worker
+    """
+    return '{}/{}'.format(os.getpid(), threading.current_thread().name)
+
+
+def traced_call(fn, *args, **kwargs):
+    """
+    call the function in the worker and record where and when it runs,
+    the exception is returned instead of raised so that the timing is not lost
+    :return: the exception raised (or None), the worker, the start and the end time
+    """
+    start = time.time()
+    error = None
+    try:
+        fn(*args, **kwargs)
+    except Exception as e:
+        error = e
+    return error, current_worker(), start, time.time()
+
+
+async def traced_call_async(fn, *args, **kwargs):
+    """
+    the coroutine version of *traced_call*, which awaits the coroutine function in the event loop
+    :return: the exception raised (or None), the worker, the start and the end time
+    """
+    start = time.time()
+    error = None
+    try:
+        await fn(*args, **kwargs)
+    except Exception as e:
+        error = e
+    return error, current_worker(), start, time.time()
+
+
+class FlowTracer(object):
+    """
+    the recorder of the task executions and the runner gauges,
+    which can be exported as chrome trace-events or a summary table
+    """
+    OUTCOME_SUCCESS = 'success'
+    OUTCOME_FAILED = 'failed'
+    OUTCOME_SKIPPED = 'skipped'
+
+    def __init__(self, limit=100000):
+        """
+        :param limit: the max number of the task records and the gauge samples kept
+        """
+        self.lock = threading.Lock()
+        self.tracing = {}
+        self.records = collections.deque(maxlen=limit)
+        self.gauges = collections.deque(maxlen=limit)
+
+    def queued(self, flow, flow_id, task_names):
+        now = time.time()
+        with self.lock:
+            for task_name in task_names:
+                self.tracing[(flow, flow_id, task_name)] = {
+                    'flow': flow,
+                    'flow_id': flow_id,
+                    'task': task_name,
+                    'queued': now,
+                    'ready': None,
+                    'start': None,
+                    'end': None,
+                    'worker': None,
+                    'outcome': None,
+                }
+
+    def ready(self, flow, flow_id, task_name):
+        with self.lock:
+            record = self.tracing.get((flow, flow_id, task_name))
+            if record is not None:
+                record['ready'] = time.time()
+
+    def finished(self, flow, flow_id, task_name, outcome, worker=None, start=None, end=None):
+        with self.lock:
+            record = self.tracing.pop((flow, flow_id, task_name), None)
+            if record is None:
+                return
+            record.update(outcome=outcome, worker=worker, start=start, end=end)
+            self.records.append(record)
+
+    def gauge(self, busy, capacity, ready_depth):
+        """
+        sample the runner gauges
+        :param busy: the number of the tasks executing in the worker pools
+        :param capacity: the max number of the tasks executed at the same time
+        :param ready_depth: the number of the ready tasks waiting for a worker
+        :return:
+        """
+        with self.lock:
+            self.gauges.append((time.time(), busy, capacity, ready_depth))
+
+    def summary(self):
+        """
+        build the summary table of the finished task executions
+        :return: the dataframe with the timing of each task execution in seconds
+        """
+        with self.lock:
+            df = pd.DataFrame(list(self.records), columns=['flow', 'flow_id', 'task', 'queued', 'ready', 'start',
+                                                           'end', 'worker', 'outcome'])
+        df['wait_deps'] = df['ready'] - df['queued']
+        df['wait_worker'] = df['start'] - df['ready']
+        df['duration'] = df['end'] - df['start']
+        return df.sort_values(['queued', 'start'])
+
+    def utilisation(self):
+        """
+        the time-weighted average ratio of busy workers over the sampled period
+        :return:
+        """
+        with self.lock:
+            gauges = list(self.gauges)
+        if len(gauges) < 2:
+            return None
+        busy_time = sum([(y[0] - x[0]) * x[1] / x[2] for (x, y) in zip(gauges[:-1], gauges[1:])])
+        return busy_time / (gauges[-1][0] - gauges[0][0]) if gauges[-1][0] > gauges[0][0] else None
+
+    def to_chrome_trace(self):
+        """
+        convert the records into chrome trace-event format, which can be loaded in chrome://tracing
+        :return: the trace-event dict
+        """
+        with self.lock:
+            records = list(self.records)
+            gauges = list(self.gauges)
+
+        # the gauges and the skipped tasks are put in the process of the runner
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 0, 'args': {'name': 'runner'}}]
+        processes, workers = {}, {}
+        for record in records:
+            if record['start'] is None:
+                events.append({
+                    'name': record['task'], 'cat': record['flow'], 'ph': 'i', 's': 'g',
+                    'ts': int(record['queued'] * 1e6), 'pid': 0, 'tid': 0,
+                    'args': {'flow_id': record['flow_id'], 'outcome': record['outcome']},
+                })
+                continue
+
+            # the worker is identified by its process (maybe on another host) and its thread
+            process, thread_name = record['worker'].rsplit('/', 1)
+            if process not in processes:
+                processes[process] = len(processes) + 1
+                events.append({'name': 'process_name', 'ph': 'M', 'pid': processes[process],
+                               'args': {'name': process}})
+            if record['worker'] not in workers:
+                workers[record['worker']] = len(workers) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': processes[process],
+                               'tid': workers[record['worker']], 'args': {'name': thread_name}})
+            events.append({
+                'name': record['task'], 'cat': record['flow'], 'ph': 'X',
+                'ts': int(record['start'] * 1e6), 'dur': int((record['end'] - record['start']) * 1e6),
+                'pid': processes[process], 'tid': workers[record['worker']],
+                'args': {
+                    'flow_id': record['flow_id'],
+                    'outcome': record['outcome'],
+                    'wait_deps': record['ready'] - record['queued'] if record['ready'] else None,
+                    'wait_worker': record['start'] - record['ready'] if record['ready'] else None,
+                },
+            })
+
+        for (ts, busy, capacity, ready_depth) in gauges:
+            events.append({'name': 'workers', 'ph': 'C', 'ts': int(ts * 1e6), 'pid': 0,
+                           'args': {'busy': busy, 'idle': max(capacity - busy, 0)}})
+            events.append({'name': 'ready queue', 'ph': 'C', 'ts': int(ts * 1e6), 'pid': 0,
+                           'args': {'depth': ready_depth}})
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
@@ -1,6 +1,8 @@
 # -*- coding:utf-8 -*-
 
 import os
+import re
+import threading
 from bs4 import BeautifulSoup
 import requests
 from parade.flowstore import FlowStore
@@ -15,6 +17,9 @@ class AzkabanDAGStore(FlowStore):
     notify_mails = None
     project = None
     cmd = None
+    http = None
+    session_id = None
+    project_id = None
 
     def initialize(self, context, conf):
         FlowStore.initialize(self, context, conf)
@@ -24,34 +29,45 @@ class AzkabanDAGStore(FlowStore):
         self.notify_mails = self.conf['notifymail']
         self.project = self.conf['project']
         self.cmd = self.conf['cmd']
+        # the keep-alive session and the azkaban session id are reused by all the calls
+        self.http = requests.Session()
+        self.session_lock = threading.Lock()
 
     def _call_api(self, entry, cmd, require_login=True, method='GET', attachment=None, cmd_key='ajax', **params):
-        _params = self._init_param(require_login)
-        _params.update({cmd_key: cmd})
-        _params.update(params)
-
         url = self.host
         if len(entry) > 0:
             url += '/' + entry
 
-        if method == 'GET':
-            r = requests.get(url, params=_params)
-        else:
-            if attachment:
-                r = requests.post(url, files=attachment, data=_params)
-            else:
-                r = requests.post(url, params=_params)
-
-        if r.status_code != 200:
-            raise RuntimeError('Azkaban API execution failed')
-        try:
-            resp = r.json()
-        except Exception as e:
-            raise RuntimeError(r.text)
-        if 'error' in resp:
-            raise RuntimeError(resp['error'])
+        # retry once with a new session if the cached session is rejected
+        for attempt in range(2):
+            _params = self._init_param(require_login)
+            _params.update({cmd_key: cmd})
+            _params.update(params)
 
-        return resp
+            if method == 'GET':
+                r = self.http.get(url, params=_params)
+            else:
+                if attachment:
+                    for f in attachment.values():
+                        f[1].seek(0)
+                    r = self.http.post(url, files=attachment, data=_params)
+                else:
+                    r = self.http.post(url, params=_params)
+
+            if r.status_code != 200:
+                raise RuntimeError('Azkaban API execution failed')
+            try:
+                resp = r.json()
+            except Exception as e:
+                raise RuntimeError(r.text)
+            if 'error' in resp:
+                if require_login and attempt == 0 and 'session' in str(resp['error']).lower():
+                    logger.debug('Azkaban session expired, login again')
+                    self._invalidate_session(_params['session.id'])
+                    continue
+                raise RuntimeError(resp['error'])
+
+            return resp
 
     def _load_html(self, entry, require_login=True, **params):
         _params = self._init_param(require_login)
@@ -61,7 +77,7 @@ class AzkabanDAGStore(FlowStore):
         if len(entry) > 0:
             url += '/' + entry
 
-        r = requests.get(url, params=_params)
+        r = self.http.get(url, params=_params)
 
         if r.status_code != 200:
             raise RuntimeError('Azkaban access failed')
@@ -102,26 +118,45 @@ class AzkabanDAGStore(FlowStore):
 
     def _init_param(self, require_login=True):
         if require_login:
-            session_id = self._login()
-            return {'session.id': session_id}
+            with self.session_lock:
+                if self.session_id is None:
+                    self.session_id = self._login()
+                return {'session.id': self.session_id}
         return {}
 
+    def _invalidate_session(self, session_id):
+        with self.session_lock:
+            # the session may be renewed by another call already
+            if self.session_id == session_id:
+                self.session_id = None
+
     @property
     def _project_id(self):
-        resp = self._load_html('manager', project=self.project)
-        soup = BeautifulSoup(resp, "html.parser")
+        if self.project_id is None:
+            self.project_id = self._fetch_project_id()
+        return self.project_id
 
+    def _fetch_project_id(self):
         def script_without_src(tag):
             return tag.name == "script" and not tag.has_attr("src")
 
-        raw = soup.head.find(script_without_src).string
-        lines = map(lambda line: line.strip(), raw.strip().splitlines())
-        projectIdLine = list(filter(lambda line: line.find("projectId") >= 0, lines))[0]
-
-        import re
-        m = re.match("var projectId = (\d+);", projectIdLine)
-        project_id = m.group(1)
-        return project_id
+        for attempt in range(2):
+            resp = self._load_html('manager', project=self.project)
+            soup = BeautifulSoup(resp, "html.parser")
+            try:
+                raw = soup.head.find(script_without_src).string
+                lines = map(lambda line: line.strip(), raw.strip().splitlines())
+                projectIdLine = list(filter(lambda line: line.find("projectId") >= 0, lines))[0]
+            except (AttributeError, IndexError):
+                # the login page is returned if the cached session is rejected
+                if attempt == 0:
+                    self._invalidate_session(self.session_id)
+                    continue
+                raise RuntimeError('project id of {} not found'.format(self.project))
+
+            m = re.match("var projectId = (\d+);", projectIdLine)
+            project_id = m.group(1)
+            return project_id
 
     def _get_schedule_id(self, flow_name):
         resp = self._call_api('schedule', 'fetchSchedule', projectId=self._project_id, flowId=flow_name)
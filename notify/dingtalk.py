@@ -1,9 +1,46 @@
+import atexit
+import collections
+import queue
+import threading
+import time
+
 from parade.notify import Notifier
+from parade.utils.log import logger
 import requests
 
 
+class SlidingWindow(object):
+    """
+    the sliding window limiting the messages sent in any *period* seconds
+    """
+
+    def __init__(self, limit, period=60):
+        """
+        :param limit: the max messages sent in the window
+        :param period: the length of the window in seconds
+        """
+        self.limit = limit
+        self.period = period
+        self.sent = collections.deque()
+
+    def acquire(self):
+        """
+        record a message, wait until the earliest one in the window expires if the window is full
+        :return:
+        """
+        while True:
+            now = time.time()
+            while len(self.sent) > 0 and self.sent[0] <= now - self.period:
+                self.sent.popleft()
+            if len(self.sent) < self.limit:
+                self.sent.append(now)
+                return
+            time.sleep(self.sent[0] + self.period - now)
+
+
 class DingTalk(Notifier):
     API_GATEWAY = 'https://oapi.dingtalk.com/robot/send?access_token={target}'
+    CONNECTION_TIME_OUT = 10
     TEMPLATE_SUCCESS = """#### {title}\n
 > 任务：{task}
     """
@@ -13,16 +50,50 @@ class DingTalk(Notifier):
 > 原因：{reason}
     """
 
+    TITLE_DIGEST = 'Parade任务通知({count}条)'
+
     target = None
     attachment = None
+    gateway = API_GATEWAY
+    # send the notifications in a background thread, the notifications in *window* seconds are
+    # coalesced into one digest message with at most *digest_size* notifications
+    background = True
+    window = 5
+    digest_size = 20
+    # the robot accepts at most 20 messages per minute
+    rate_limit = 20
+    retries = 3
+    backoff = 1
+    # the max seconds to wait for the pending notifications at exit
+    shutdown_timeout = 30
 
     def initialize(self, context, conf):
         Notifier.initialize(self, context, conf)
         self.target = self.conf['target']
         self.attachment = self.conf['attachment'] if self.conf.has('attachment') else None
+        self.gateway = self.conf['gateway'] if self.conf.has('gateway') else self.gateway
+        self.background = self.conf['background'] if self.conf.has('background') else self.background
+        self.window = self.conf['window'] if self.conf.has('window') else self.window
+        self.digest_size = self.conf['digest_size'] if self.conf.has('digest_size') else self.digest_size
+        self.rate_limit = self.conf['rate_limit'] if self.conf.has('rate_limit') else self.rate_limit
+        self.retries = self.conf['retries'] if self.conf.has('retries') else self.retries
+        self.backoff = self.conf['backoff'] if self.conf.has('backoff') else self.backoff
+        self.shutdown_timeout = self.conf['shutdown_timeout'] if self.conf.has('shutdown_timeout') \
+            else self.shutdown_timeout
+
+        self.pending = queue.Queue()
+        self.limiter = SlidingWindow(self.rate_limit)
+        # the notifications taken by the sender and not sent yet
+        self.sending = []
+        self.sender = None
+        if self.background:
+            self.sender = threading.Thread(target=self._send_loop, name='dingtalk-sender', daemon=True)
+            self.sender.start()
+            # flush the pending notifications before the process exits
+            atexit.register(self.shutdown)
 
     @staticmethod
-    def send_notify(target, title, content):
+    def send_notify(target, title, content, gateway=API_GATEWAY, timeout=CONNECTION_TIME_OUT):
         message = {
             "msgtype": "markdown",
             "markdown": {
@@ -33,7 +104,7 @@ class DingTalk(Notifier):
                 "isAtAll": True
             }
         }
-        r = requests.post(DingTalk.API_GATEWAY.format(target=target), json=message)
+        r = requests.post(gateway.format(target=target), json=message, timeout=timeout)
         if r.status_code != 200:
             raise RuntimeError('Notify server error')
         else:
@@ -41,13 +112,98 @@ class DingTalk(Notifier):
             if resp['errcode'] != 0:
                 raise RuntimeError(r.json()['errmsg'])
 
+    def _send(self, title, content):
+        """
+        send the message within the rate limit, retry with exponential backoff if it fails
+        :return:
+        """
+        for retry_time in range(0, self.retries):
+            self.limiter.acquire()
+            try:
+                self.send_notify(self.target, title, content, gateway=self.gateway)
+                return
+            except Exception as e:
+                logger.warning('failed to send notification [{}]: {}'.format(title, e))
+            if retry_time < self.retries - 1:
+                time.sleep(self.backoff * 2 ** retry_time)
+        logger.error('notification [{}] dropped after {} attempts'.format(title, self.retries))
+
+    def _send_digest(self, notifications):
+        """
+        send the notifications in digests, the sent ones are removed from the list
+        :return:
+        """
+        while len(notifications) > 0:
+            batch = notifications[:self.digest_size]
+            if len(batch) == 1:
+                self._send(*batch[0])
+            else:
+                title = self.TITLE_DIGEST.format(count=len(batch))
+                self._send(title, '\n---\n'.join([content for (_, content) in batch]))
+            del notifications[:len(batch)]
+
+    def _send_loop(self):
+        """
+        the background sender, which coalesces the notifications in each window into digests
+        :return:
+        """
+        stopped = False
+        while not stopped:
+            notification = self.pending.get()
+            if notification is None:
+                break
+            notifications = [notification]
+            deadline = time.time() + self.window
+            while time.time() < deadline:
+                try:
+                    notification = self.pending.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if notification is None:
+                    # send the collected ones at once when shutting down
+                    stopped = True
+                    break
+                notifications.append(notification)
+            self.sending = notifications
+            try:
+                self._send_digest(notifications)
+            except Exception as e:
+                logger.exception(str(e))
+            self.sending = []
+
+    def shutdown(self):
+        """
+        stop the background sender after the pending notifications are sent,
+        the ones not sent in *shutdown_timeout* seconds are dropped
+        :return:
+        """
+        if self.sender is not None and self.sender.is_alive():
+            self.pending.put(None)
+            self.sender.join(self.shutdown_timeout)
+            if self.sender.is_alive():
+                dropped = list(self.sending)
+                while True:
+                    try:
+                        notification = self.pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if notification is not None:
+                        dropped.append(notification)
+                logger.error('{} notifications unsent as the sender did not finish in {} seconds: {}'.format(
+                    len(dropped), self.shutdown_timeout, [title for (title, _) in dropped]))
+
+    def _notify(self, title, content):
+        if self.sender is not None:
+            self.pending.put((title, content))
+        else:
+            self.send_notify(self.target, title, content, gateway=self.gateway)
+
     def notify_error(self, task, reason, **kwargs):
         title = 'Parade任务执行失败'
         content = self.TEMPLATE_FAIL.format(title=title, task=task, reason=reason)
-        self.send_notify(self.target, title, content)
+        self._notify(title, content)
 
     def notify_success(self, task, **kwargs):
         title = 'Parade任务执行成功'
         content = self.TEMPLATE_SUCCESS.format(title=title, task=task)
-        self.send_notify(self.target, title, content)
-
+        self._notify(title, content)
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# the plugins are imported from the root of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Conf(dict):
+    """
+    the conf passed to the plugins, as the one parsed from the parade config
+    """
+
+    def has(self, key):
+        return key in self and self[key] is not None
+
+
+class Context(object):
+    def __init__(self, workdir, tasks=None):
+        self.workdir = workdir
+        self.task_dict = tasks if tasks is not None else {}
+
+
+@pytest.fixture(scope='session')
+def redis_server():
+    """
+    the address of the local redis-server for test (set by REDIS_HOST and REDIS_PORT), None if not reachable
+    """
+    redis = pytest.importorskip('redis')
+    address = (os.environ.get('REDIS_HOST', 'localhost'), int(os.environ.get('REDIS_PORT', 6379)))
+    try:
+        redis.StrictRedis(host=address[0], port=address[1], socket_connect_timeout=1).ping()
+        return address
+    except redis.RedisError:
+        return None
+
+
+@pytest.fixture
+def redis_factory(redis_server):
+    """
+    the factory of the clients to the redis for test, the local redis-server is used if reachable,
+    otherwise fakeredis if installed
+    """
+    if redis_server is not None:
+        import redis
+        conn = redis.StrictRedis(host=redis_server[0], port=redis_server[1], db=15)
+        conn.flushdb()
+        yield lambda: redis.StrictRedis(host=redis_server[0], port=redis_server[1], db=15)
+        conn.flushdb()
+        return
+
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    yield lambda: fakeredis.FakeStrictRedis(server=server)
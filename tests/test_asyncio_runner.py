@@ -0,0 +1,39 @@
+import time
+
+import pytest
+
+pytest.importorskip('parade')
+
+from parade.core.task import Flow
+
+from flowrunner.asyncio import AsyncioRunner
+from conftest import Conf, Context
+
+
+class BlockingTask(object):
+    def __init__(self, name, runner_ref, executed):
+        self.name = name
+        self.runner_ref = runner_ref
+        self.executed = executed
+
+    def execute(self, context, **kwargs):
+        self.executed.append((self.name, self.runner_ref[0].busy))
+        time.sleep(0.02)
+
+
+def test_blocking_tasks_wait_in_queue_for_workers(tmpdir):
+    runner_ref, executed = [], []
+    names = ['t{}'.format(i) for i in range(6)]
+    context = Context(str(tmpdir), dict([(name, BlockingTask(name, runner_ref, executed)) for name in names]))
+    runner = AsyncioRunner()
+    runner.initialize(context, Conf(pool_size=1, detach=True))
+    runner_ref.append(runner)
+    # the later tasks are known to be longer, so they are more critical
+    runner.task_durations = dict([(name, [i + 1]) for (i, name) in enumerate(names)])
+    try:
+        assert runner.submit(Flow('blocking', names)).result(timeout=30)
+    finally:
+        runner.shutdown()
+
+    assert [name for (name, _) in executed] == list(reversed(names))
+    assert max([busy for (_, busy) in executed]) == 1
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+pytest.importorskip('parade')
+
+from parade.core.task import Flow
+
+from flowrunner.dag import DAGFlowRunner, FlowExecution
+from flowrunner.asyncio import AsyncioRunner
+from flowrunner.tornado import TornadoRunner
+from conftest import Conf, Context
+
+
+class QueueRunner(DAGFlowRunner):
+    """
+    the runner keeping the exec-queue in a list to check the dispatch order
+    """
+
+    def initialize(self, context, conf):
+        DAGFlowRunner.initialize(self, context, conf)
+        self.queue = []
+
+    def _put_ready(self, priority, execution, task_name):
+        self.queue.append(priority + (execution.flow.name, task_name))
+
+    def _ready_depth(self):
+        return len(self.queue)
+
+
+def test_small_flow_not_starved_by_wide_flow(tmpdir):
+    wide_tasks = ['w{}'.format(i) for i in range(10)]
+    runner = QueueRunner()
+    runner.initialize(Context(str(tmpdir), dict([(name, None) for name in wide_tasks + ['s']])), Conf())
+    # the wide tasks are known to be longer
+    runner.task_durations = dict([(name, [10]) for name in wide_tasks] + [('s', [1])])
+
+    runner._start_flow(FlowExecution(Flow('wide', wide_tasks), max_concurrency=runner.flow_concurrency))
+    runner._start_flow(FlowExecution(Flow('small', ['s']), max_concurrency=runner.flow_concurrency))
+
+    order = [task_name for (_, _, _, _, task_name) in sorted(runner.queue)]
+    assert order.index('s') <= 1
+    runner.shutdown()
+
+
+def test_flow_backlog_kept_in_critical_path_order(tmpdir):
+    tasks = ['t{}'.format(i) for i in range(10)]
+    runner = QueueRunner()
+    runner.initialize(Context(str(tmpdir), dict([(name, None) for name in tasks])), Conf(concurrency=2))
+    runner.task_durations = dict([(name, [i + 1]) for (i, name) in enumerate(tasks)])
+
+    execution = FlowExecution(Flow('wide', tasks), max_concurrency=runner.flow_concurrency)
+    runner._start_flow(execution)
+    assert [task_name for (_, _, _, _, task_name) in sorted(runner.queue)] == ['t9', 't8']
+    assert len(execution.ready) == 8
+    runner.shutdown()
+
+
+class MarkerTask(object):
+    executor = 'process'
+
+    def __init__(self, name):
+        self.name = name
+
+    def execute(self, context, **kwargs):
+        with open(os.path.join(context.workdir, self.name), 'w') as f:
+            f.write(str(os.getpid()))
+
+
+@pytest.mark.parametrize('runner_class', [TornadoRunner, AsyncioRunner])
+def test_process_tasks_with_runner_in_context(tmpdir, runner_class):
+    context = Context(str(tmpdir), dict([(name, MarkerTask(name)) for name in 'ab']))
+    runner = runner_class()
+    runner.initialize(context, Conf(process_pool_size=1, detach=True))
+    # the context caches the runner holding the pools and the queues, as the one of parade
+    context._flowrunner = runner
+    try:
+        assert runner.submit(Flow('process', ['a', 'b'], {'b': {'a'}})).result(timeout=60)
+    finally:
+        runner.shutdown()
+    for name in 'ab':
+        with open(os.path.join(str(tmpdir), name)) as f:
+            assert int(f.read()) != os.getpid()
@@ -0,0 +1,101 @@
+import atexit
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('parade')
+
+from notify.dingtalk import DingTalk, SlidingWindow
+from conftest import Conf, Context
+
+
+@pytest.fixture
+def robot_server():
+    """
+    the stub robot gateway recording the messages, the first *failures* messages are rejected
+    """
+    import http.server
+
+    state = {'received': [], 'failures': 0}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            state['received'].append((time.time(), message))
+            if state['failures'] > 0:
+                state['failures'] -= 1
+                resp = {'errcode': 130101, 'errmsg': 'send too fast'}
+            else:
+                resp = {'errcode': 0, 'errmsg': 'ok'}
+            body = json.dumps(resp).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['gateway'] = 'http://127.0.0.1:{}/robot/send?access_token={{target}}'.format(server.server_address[1])
+    yield state
+    server.shutdown()
+
+
+def _notifier(tmpdir, robot_server, **conf):
+    notifier = DingTalk()
+    notifier.initialize(Context(str(tmpdir)), Conf(target='token', gateway=robot_server['gateway'], **conf))
+    return notifier
+
+
+def test_digest_flushed_at_shutdown(tmpdir, robot_server):
+    notifier = _notifier(tmpdir, robot_server, window=5)
+    for task in ('a', 'b', 'c'):
+        notifier.notify_success(task)
+    notifier.shutdown()
+
+    assert len(robot_server['received']) == 1
+    markdown = robot_server['received'][0][1]['markdown']
+    assert markdown['title'] == DingTalk.TITLE_DIGEST.format(count=3)
+    assert all(['任务：' + task in markdown['text'] for task in ('a', 'b', 'c')])
+
+
+def test_failed_message_retried(tmpdir, robot_server):
+    robot_server['failures'] = 1
+    notifier = _notifier(tmpdir, robot_server, window=0, retries=2, backoff=0.01)
+    notifier.notify_error('a', 'failed')
+    notifier.shutdown()
+
+    assert len(robot_server['received']) == 2
+    assert robot_server['received'][0][1] == robot_server['received'][1][1]
+
+
+def test_messages_within_rate_window(tmpdir, robot_server):
+    notifier = _notifier(tmpdir, robot_server, window=0.1, digest_size=1)
+    notifier.limiter = SlidingWindow(2, period=0.5)
+    for task in ('a', 'b', 'c'):
+        notifier.notify_success(task)
+    notifier.shutdown()
+
+    sent_times = [sent_time for (sent_time, _) in robot_server['received']]
+    assert len(sent_times) == 3
+    assert sent_times[2] - sent_times[0] >= 0.45
+
+
+def test_unsent_messages_dropped_at_shutdown(tmpdir, robot_server, caplog):
+    notifier = _notifier(tmpdir, robot_server, window=0.1, digest_size=1, shutdown_timeout=0.3)
+    notifier.limiter = SlidingWindow(1, period=60)
+    for task in ('a', 'b', 'c'):
+        notifier.notify_success(task)
+    start = time.time()
+    notifier.shutdown()
+
+    assert time.time() - start < 5
+    assert len(robot_server['received']) == 1
+    assert '2 notifications unsent' in caplog.text
+    # the sender is still waiting for the window, which is dropped at exit
+    atexit.unregister(notifier.shutdown)
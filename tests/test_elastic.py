@@ -0,0 +1,34 @@
+import types
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('parade')
+pytest.importorskip('elasticsearch')
+
+import connection.elastic as elastic
+
+
+@pytest.fixture
+def es_conn(monkeypatch):
+    conn = elastic.ElasticConnection.__new__(elastic.ElasticConnection)
+    conn.datasource = types.SimpleNamespace(db='stat')
+    conn.open = lambda: None
+
+    def _bulk(es, actions, **kwargs):
+        # reject the documents with negative pv
+        docs = [action['_source'] for action in actions]
+        failed = len([doc for doc in docs if doc['pv'] < 0])
+        return len(docs) - failed, failed
+
+    monkeypatch.setattr(elastic.helpers, 'bulk', _bulk)
+    monkeypatch.setattr(conn, '_gen_actions', lambda chunk, index, table: (
+        {'_index': index, '_source': row} for row in chunk.to_dict(orient='records')))
+    return conn
+
+
+def test_append_raises_on_rejected_documents(es_conn):
+    df = pd.DataFrame({'pv': [1, -1, 2]})
+    with pytest.raises(RuntimeError, match='1 of 3 documents'):
+        es_conn.store(df, 'daily', chunk_size=2)
+    assert es_conn.store(df, 'daily', chunk_size=2, raise_on_error=False) == [(1, 1), (1, 0)]
@@ -0,0 +1,155 @@
+import os
+import types
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('parade')
+
+from connection.loghub import Loghub
+
+
+def test_infer_schema_keeps_ids_as_strings():
+    df = pd.DataFrame({
+        'id': ['007', '1'],
+        'trace': ['12345678901234567890', '1'],
+        'latency': ['1', '2.5'],
+        '__time__': ['1600000000', '1600000001'],
+    })
+    schema = Loghub._infer_schema(df)
+    assert schema == {'latency': 'numeric', '__time__': 'datetime'}
+
+    df = Loghub._coerce(df, schema, inferred=True)
+    assert df['id'].tolist() == ['007', '1']
+    assert df['latency'].tolist() == [1, 2.5]
+    assert df['__time__'].tolist() == [pd.Timestamp(1600000000, unit='s'), pd.Timestamp(1600000001, unit='s')]
+
+
+def test_inferred_chunks_keep_unconvertible_values(caplog):
+    pages = iter([[{'code': '1'}, {'code': '2'}], [{'code': 'x'}]])
+    chunks = list(Loghub._iter_chunks(Loghub.__new__(Loghub), pages, 2))
+    assert chunks[0]['code'].tolist() == [1, 2]
+    assert chunks[1]['code'].tolist() == ['x']
+    assert 'field code is kept as strings' in caplog.text
+
+
+def test_inferred_chunks_without_category():
+    pages = iter([[{'level': 'info'}] * 4, [{'level': 'warn'}] * 4])
+    chunks = list(Loghub._iter_chunks(Loghub.__new__(Loghub), pages, 4))
+    assert [chunk['level'].dtype for chunk in chunks] == [chunks[0]['level'].dtype] * 2
+    assert pd.concat(chunks)['level'].tolist() == ['info'] * 4 + ['warn'] * 4
+    assert not isinstance(chunks[0]['level'].dtype, pd.CategoricalDtype)
+
+
+def test_given_schema_coerces_values():
+    df = Loghub._coerce(pd.DataFrame({'code': ['1', 'x']}), {'code': 'numeric'})
+    assert df['code'].iloc[0] == 1
+    assert pd.isna(df['code'].iloc[1])
+
+
+@pytest.mark.parametrize('progress', ['Complete', 'Incomplete'])
+def test_cache_only_complete_windows(tmpdir, progress):
+    from conftest import Context
+
+    loghub = Loghub.__new__(Loghub)
+    loghub.context = Context(str(tmpdir))
+    loghub.datasource = types.SimpleNamespace(db='project')
+    loghub.retries, loghub.backoff, loghub.concurrency = 1, 0, 2
+    loghub.cache_window, loghub.cache_lag, loghub.cache_size = 3600, 600, 1024 * 1024
+    loghub.get_histograms = lambda *args, **kwargs: (
+        [{'from': 0, 'to': 3600, 'count': 2}], {'x-log-progress': 'Complete'})
+    loghub.get_logs = lambda *args: ([{'code': '1'}, {'code': '2'}], {'x-log-progress': progress})
+
+    query = {'logstore': 'access', 'topic': '', 'query': '*', 'from': 0, 'to': 3600}
+    df = loghub.load_query(query, cache=True)
+    assert df['code'].tolist() == [1, 2]
+    cache_file = loghub._cache_file('access', '*', '', 0, 3600)
+    assert os.path.exists(cache_file) == (progress == 'Complete')
+
+
+def _decode_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def _decode_fields(data):
+    """
+    decode the protobuf message into the list of (field number, value), the values are ints or bytes
+    """
+    fields, pos = [], 0
+    while pos < len(data):
+        tag, pos = _decode_varint(data, pos)
+        if tag & 7 == 0:
+            value, pos = _decode_varint(data, pos)
+        else:
+            length, pos = _decode_varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        fields.append((tag >> 3, value))
+    return fields
+
+
+@pytest.fixture
+def loghub_server():
+    """
+    the stub log service recording the PutLogs requests
+    """
+    import http.server
+    import threading
+
+    received = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((self.path, dict(self.headers.items()), body))
+            self.send_response(200)
+            self.send_header('x-log-requestid', 'stub')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1], received
+    server.shutdown()
+
+
+def test_store_put_logs(loghub_server):
+    import zlib
+
+    port, received = loghub_server
+    loghub = Loghub.__new__(Loghub)
+    loghub.datasource = types.SimpleNamespace(uri='http://127.0.0.1:{}'.format(port), protocol='http',
+                                              host='127.0.0.1', port=port, db='project', user='key-id',
+                                              password='key-secret')
+    loghub.retries, loghub.backoff, loghub.concurrency, loghub.pool_size = 1, 0, 2, 2
+
+    df = pd.DataFrame({'__time__': [1600000000, 1600000001], 'code': [200, None], 'path': ['/a', '/b']})
+    assert loghub.store(df, 'access', topic='web', source='10.0.0.1') == 2
+
+    assert len(received) == 1
+    path, headers, body = received[0]
+    assert path == '/logstores/access/shards/lb'
+    assert headers['x-log-compresstype'] == 'deflate'
+    raw = zlib.decompress(body)
+    assert int(headers['x-log-bodyrawsize']) == len(raw)
+
+    signature = Loghub.get_request_authorization('POST', '/logstores/access/shards/lb', 'key-secret', {}, headers)
+    assert headers['Authorization'] == 'LOG key-id:' + signature.decode()
+
+    group = _decode_fields(raw)
+    assert [value for (number, value) in group if number == 3] == [b'web']
+    assert [value for (number, value) in group if number == 4] == [b'10.0.0.1']
+    logs = [_decode_fields(value) for (number, value) in group if number == 1]
+    assert [log[0] for log in logs] == [(1, 1600000000), (1, 1600000001)]
+    contents = [[tuple(v for (_, v) in _decode_fields(content)) for (number, content) in log if number == 2]
+                for log in logs]
+    assert contents == [[(b'code', b'200.0'), (b'path', b'/a')], [(b'path', b'/b')]]
@@ -0,0 +1,105 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('parade')
+
+from connection.redis_counter import RedisCounterConnection
+
+
+@pytest.fixture
+def counter(redis_factory):
+    conn = RedisCounterConnection.__new__(RedisCounterConnection)
+    conn.open = redis_factory
+    return conn
+
+
+def _sorted(df, by):
+    return df.sort_values(by).reset_index(drop=True)
+
+
+def test_hash_layout_round_trip_dash_key(counter):
+    df = pd.DataFrame({'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2], 'uv': [1.5, 2.5]})
+    counter.store(df, 'stat', pkey='date', layout='hash')
+
+    loaded = _sorted(counter.load('stat', pkey='date', layout='hash'), 'date')
+    assert loaded['date'].tolist() == ['2020-01-01', '2020-01-02']
+    assert loaded['pv'].tolist() == [1, 2]
+    assert loaded['uv'].tolist() == [1.5, 2.5]
+
+
+def test_hash_layout_multiple_pkey(counter):
+    df = pd.DataFrame({'city': ['a', 'b'], 'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2]})
+    counter.store(df, ('stat', 'daily'), pkey=('city', 'date'), layout='hash')
+
+    loaded = _sorted(counter.load(('stat', 'daily'), pkey=('city', 'date'), layout='hash'), 'city')
+    assert loaded[['city', 'date']].values.tolist() == [['a', '2020-01-01'], ['b', '2020-01-02']]
+    assert loaded['pv'].tolist() == [1, 2]
+
+
+def test_key_layout_round_trip_dash_key(counter):
+    df = pd.DataFrame({'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2], 'uv': [1.5, 2.5]})
+    counter.store(df, 'stat', pkey='date')
+
+    loaded = _sorted(counter.load('stat', pkey='date'), 'date')
+    assert loaded['date'].tolist() == ['2020-01-01', '2020-01-02']
+    assert loaded['pv'].tolist() == [1, 2]
+    assert loaded['uv'].tolist() == [1.5, 2.5]
+
+
+def test_key_layout_multiple_pkey(counter):
+    df = pd.DataFrame({'city': ['a', 'b'], 'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2]})
+    counter.store(df, 'stat', pkey=('city', 'date'), batch_size=1, pipeline_size=1)
+
+    loaded = _sorted(counter.load('stat', pkey=('city', 'date'), batch_size=1, pipeline_size=1), 'city')
+    assert loaded[['city', 'date']].values.tolist() == [['a', '2020-01-01'], ['b', '2020-01-02']]
+    assert loaded['pv'].tolist() == [1, 2]
+
+
+def test_load_query(counter):
+    counter.store({'pv': 1, 'uv': 2}, 'total')
+
+    loaded = counter.load_query('total:counter:*').sort_values('key')
+    assert loaded['key'].tolist() == ['total:counter:pv', 'total:counter:uv']
+    assert loaded['value'].tolist() == [1, 2]
+
+
+def _duplicated_scan(counter):
+    """
+    make SCAN return every key twice, as it may during a rehash
+    """
+    open_redis = counter.open
+
+    def _open():
+        conn = open_redis()
+        scan_iter = conn.scan_iter
+        conn.scan_iter = lambda *args, **kwargs: [k for key in scan_iter(*args, **kwargs) for k in (key, key)]
+        return conn
+
+    counter.open = _open
+
+
+def test_key_layout_duplicated_scan(counter):
+    counter.store(pd.DataFrame({'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2]}), 'stat', pkey='date')
+    _duplicated_scan(counter)
+
+    loaded = _sorted(counter.load('stat', pkey='date'), 'date')
+    assert loaded['pv'].tolist() == [1, 2]
+
+
+def test_load_query_wide(counter):
+    counter.store(pd.DataFrame({'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2], 'uv': [3, 4]}),
+                  'stat', pkey='date')
+    counter.store({'pv': 1}, 'total')
+
+    loaded = _sorted(counter.load_query('*:counter:*', table='stat', pkey='date'), 'date')
+    assert loaded.columns.tolist() == ['date', 'pv', 'uv']
+    assert loaded.values.tolist() == [['2020-01-01', 1, 3], ['2020-01-02', 2, 4]]
+
+
+def test_hash_layout_duplicated_scan(counter):
+    counter.store(pd.DataFrame({'date': ['2020-01-01', '2020-01-02'], 'pv': [1, 2]}), 'stat', pkey='date',
+                  layout='hash')
+    _duplicated_scan(counter)
+
+    loaded = _sorted(counter.load('stat', pkey='date', layout='hash'), 'date')
+    assert loaded['pv'].tolist() == [1, 2]
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('parade')
+
+from parade.core.task import Flow
+
+import flowrunner.redis as redis_runner
+from conftest import Conf, Context
+
+
+class SleepTask(object):
+    def __init__(self, duration=0.05):
+        self.duration = duration
+        self.executed = 0
+
+    def execute(self, context, **kwargs):
+        self.executed += 1
+        time.sleep(self.duration)
+
+
+@pytest.fixture
+def runner_env(tmpdir, monkeypatch, redis_factory):
+    monkeypatch.setattr(redis_runner, '_open_redis', lambda conf: redis_factory())
+    context = Context(str(tmpdir), dict([(name, SleepTask()) for name in 'abcd']))
+    conf = Conf(lease=1, poll_interval=0.05, workers=2, detach=True, prefix='parade:test')
+    runner = redis_runner.RedisRunner()
+    runner.initialize(context, conf)
+    workers = []
+
+    def start_worker():
+        worker = redis_runner.RedisTaskWorker(context, conf)
+        threading.Thread(target=worker.run, daemon=True).start()
+        workers.append(worker)
+        return worker
+
+    yield runner, context, start_worker
+    for worker in workers:
+        worker.stop()
+    runner.shutdown()
+
+
+def _flow():
+    return Flow('redis-flow', list('abcd'), {'c': {'a', 'b'}, 'd': {'c'}})
+
+
+def test_flow_completed_by_workers(runner_env):
+    runner, context, start_worker = runner_env
+    start_worker()
+    assert runner.submit(_flow(), 1).result(timeout=30)
+    assert all([task.executed == 1 for task in context.task_dict.values()])
+
+
+def test_expired_lease_retried(runner_env):
+    runner, context, start_worker = runner_env
+    future = runner.submit(_flow(), 1)
+    time.sleep(0.3)
+
+    # a worker claims a task and dies without heartbeat
+    dead = redis_runner.RedisTaskWorker(context, Conf(lease=1, prefix='parade:test'))
+    assert dead.claim_script(keys=[dead.ready_key, dead.running_key], args=[dead.lease]) is not None
+
+    start_worker()
+    assert future.result(timeout=30)
+    assert len(runner.inflight) == 0
+
+
+def test_lost_message_retried(runner_env):
+    runner, context, start_worker = runner_env
+    future = runner.submit(_flow(), 1)
+    time.sleep(0.3)
+
+    # the published messages are lost, e.g. by a failover of redis
+    runner.redis.delete(runner.ready_key)
+
+    start_worker()
+    assert future.result(timeout=30)
+    assert all([task.executed == 1 for task in context.task_dict.values()])
+
+
+def test_failed_publish_retried(runner_env, monkeypatch):
+    runner, context, start_worker = runner_env
+    execute_command = runner.redis.execute_command
+    failures = [2]
+
+    def flaky_execute_command(*args, **kwargs):
+        if args[0] == 'ZADD' and failures[0] > 0:
+            failures[0] -= 1
+            raise redis_runner.redis.ConnectionError('connection lost')
+        return execute_command(*args, **kwargs)
+
+    monkeypatch.setattr(runner.redis, 'execute_command', flaky_execute_command)
+    start_worker()
+    assert runner.submit(_flow(), 1).result(timeout=30)
+    assert failures[0] == 0
+    assert all([task.executed == 1 for task in context.task_dict.values()])
+
+
+def test_failed_task_reported(runner_env):
+    runner, context, start_worker = runner_env
+
+    class FailedTask(SleepTask):
+        def execute(self, context, **kwargs):
+            raise ValueError('failed')
+
+    context.task_dict['c'] = FailedTask()
+    start_worker()
+    assert not runner.submit(_flow(), 1).result(timeout=30)
+    assert context.task_dict['d'].executed == 0
+
+
+def test_gauge_without_redis(runner_env, monkeypatch):
+    runner, context, start_worker = runner_env
+
+    def failed_zcard(*args, **kwargs):
+        raise redis_runner.redis.ConnectionError('connection lost')
+
+    monkeypatch.setattr(runner.redis, 'zcard', failed_zcard)
+    start_worker()
+    assert runner.submit(_flow(), 1).result(timeout=30)
+
+
+@pytest.mark.parametrize('failures', [1, 3])
+def test_failed_report_retried(runner_env, failures):
+    runner, context, start_worker = runner_env
+    worker = start_worker()
+    worker.report_backoff = 0.05
+    complete_script = worker.complete_script
+    remaining = [failures]
+
+    def flaky_complete_script(*args, **kwargs):
+        if remaining[0] > 0:
+            remaining[0] -= 1
+            raise redis_runner.redis.ConnectionError('connection lost')
+        return complete_script(*args, **kwargs)
+
+    worker.complete_script = flaky_complete_script
+    assert runner.submit(_flow(), 1).result(timeout=30)
+    assert remaining[0] == 0
+    assert len(worker.claimed) == 0
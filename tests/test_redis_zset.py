@@ -0,0 +1,33 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('parade')
+
+from connection.redis_zset import RedisZSetConnection
+
+
+@pytest.fixture
+def zset(redis_factory):
+    conn = RedisZSetConnection.__new__(RedisZSetConnection)
+    conn.open = redis_factory
+    return conn
+
+
+def test_top_without_retention(zset):
+    zset.store({1: {'a': 1, 'b': 2}}, 'rank')
+    zset.store(pd.DataFrame({'suffix': [1, 1, 1], 'member': ['a', 'a', 'c'], 'score': [2, 1, 1]}), 'rank')
+
+    top = zset.load('rank', suffix=1, k=2)
+    assert top.values.tolist() == [['a', 4.0], ['b', 2.0]]
+
+
+def test_top_rollup_of_daily_sets(zset):
+    today = datetime.date.today()
+    for i in range(7):
+        date = today - datetime.timedelta(days=i)
+        zset.store({'pv': {'a': i, 'b': 1}}, 'rank', retention=30, date=date)
+
+    assert zset.top('rank', 'pv', k=1, date=today, retention=30).values.tolist() == [['b', 1.0]]
+    assert zset.top('rank', 'pv', k=1, days=7, date=today, retention=30).values.tolist() == [['a', 21.0]]